@@ -0,0 +1,59 @@
+# Compares the payload formats on the messages the remote actually sends and
+# receives. Runs under CPython or the MicroPython unix port, from the top of
+# the tree:
+#
+#     PYTHONPATH=src python3 bench/bench_formats.py
+#     MICROPYPATH=src micropython bench/bench_formats.py
+import formats
+
+try:
+    from utime import ticks_us, ticks_diff
+except ImportError:
+    import time
+
+    def ticks_us() -> int:
+        return time.perf_counter_ns() // 1000
+
+    def ticks_diff(a: int, b: int) -> int:
+        return a - b
+
+try:
+    from typing import Any
+except ImportError:
+    pass
+
+ITERATIONS = 2000
+FORMATS = ("json", "cbor", "msgpack")
+
+PAYLOADS = [
+    ("state scenes", ["auto", "night", "rainbow"]),
+    ("state priorities", [100, 50, 25]),
+    ("command turn_on", {"scene": "auto", "priority": 100}),
+    ("command turn_off", {"scene": "auto", "priority": 100, "action": "turn_off"}),
+    ("battery", 2873),
+    ("metrics", {
+        "debounce": {"count": 12, "p50_us": 32768, "p95_us": 65536, "max_us": 40211},
+        "state": {"count": 12, "p50_us": 131072, "p95_us": 262144, "max_us": 190322},
+    }),
+]
+
+
+def _time(func: Any, arg: Any) -> float:
+    start = ticks_us()
+    for _ in range(ITERATIONS):
+        func(arg)
+    return ticks_diff(ticks_us(), start) / ITERATIONS
+
+
+def main() -> None:
+    print("{:18} {:8} {:>6} {:>10} {:>10}".format("payload", "format", "bytes", "loads_us", "dumps_us"))
+    for name, data in PAYLOADS:
+        for format in FORMATS:
+            payload = formats.encode(data, format)
+            assert formats.decode(payload, format) == data
+            loads_us = _time(lambda p: formats.decode(p, format), payload)
+            dumps_us = _time(lambda d: formats.encode(d, format), data)
+            print("{:18} {:8} {:6} {:10.2f} {:10.2f}".format(name, format, len(payload), loads_us, dumps_us))
+
+
+main()
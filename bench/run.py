@@ -0,0 +1,185 @@
+# Runs the benchmarks in bench/suite.py and writes the results as JSON.
+# Runs under CPython, using the stand-ins in host/runtime. From the top of
+# the tree:
+#
+#     python3 bench/run.py [options]
+#
+# Options:
+#     --output FILE       write the results to FILE as JSON
+#     --compare FILE      compare against earlier results; exit 1 on a
+#                         regression
+#     --threshold PCT     allowed slow down or allocation growth, default 10
+#     --filter TEXT       only run benchmarks whose name contains TEXT
+#     --scale N           multiply the number of calls per run by N
+#
+# Each benchmark reports the calls per second, from the fastest of five
+# runs, and the peak memory traced during a run of ALLOC_CALLS calls.
+#
+# The suite does not run on the MicroPython unix port. It needs stand-ins
+# for machine, neopixel and mqtt_as, and the ones in host/runtime are
+# written for CPython: their utime needs time.monotonic_ns(), and their
+# uasyncio and asyn are built on CPython's asyncio. bench/bench_formats.py
+# needs only src/ and runs there.
+import gc
+import json
+import sys
+
+_here = __file__.rsplit("/", 1)[0] if "/" in __file__ else "."
+ROOT = _here + "/.."
+
+if sys.implementation.name != "cpython":
+    print("run.py needs CPython; bench/bench_formats.py runs under MicroPython")
+    sys.exit(2)
+
+sys.path[0:0] = [ROOT + "/host/runtime", ROOT + "/src"]
+
+import utime  # noqa: E402
+
+try:
+    from typing import Any, Dict, List, Optional
+except ImportError:
+    pass
+
+WARMUP = 20
+REPEATS = 5
+ALLOC_CALLS = 100
+
+
+def _quiet(func: Any) -> Any:
+    # Setup prints a lot; keep it out of the report.
+    import contextlib
+    import io
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func()
+
+
+def _alloc(op: Any) -> Dict[str, Any]:
+    import tracemalloc
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(ALLOC_CALLS):
+        op(i)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "peak_bytes": peak - before,
+        "retained_bytes_per_op": (current - before) / ALLOC_CALLS,
+    }
+
+
+def measure(factory: Any, calls: int) -> Dict[str, Any]:
+    op = _quiet(factory)
+    for i in range(WARMUP):
+        op(i)
+    # The fastest of several runs is the least disturbed by everything
+    # else going on.
+    elapsed_us = None
+    for _ in range(REPEATS):
+        gc.collect()
+        start = utime.ticks_us()
+        for i in range(calls):
+            op(i)
+        run_us = utime.ticks_diff(utime.ticks_us(), start)
+        if elapsed_us is None or run_us < elapsed_us:
+            elapsed_us = run_us
+    result = {
+        "calls": calls,
+        "ops_per_sec": calls * 1000000 / max(elapsed_us, 1),
+        "us_per_op": elapsed_us / calls,
+    }
+    result.update(_alloc(op))
+    return result
+
+
+def run(filter: Optional[str], scale: float) -> Dict[str, Any]:
+    from suite import BENCHMARKS
+
+    results = {}
+    for name in sorted(BENCHMARKS.keys()):
+        if filter and filter not in name:
+            continue
+        factory, calls = BENCHMARKS[name]
+        results[name] = measure(factory, max(1, int(calls * scale)))
+        print("{:24} {:12.0f} ops/s {:10.2f} us/op".format(
+            name, results[name]["ops_per_sec"], results[name]["us_per_op"]))
+    return {
+        "implementation": sys.implementation.name,
+        "version": sys.version,
+        "platform": sys.platform,
+        "results": results,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    # Returns the benchmarks that are slower, or allocate more, than the
+    # baseline by more than threshold percent.
+    regressions = []
+    if current["implementation"] != baseline["implementation"]:
+        print("Baseline is from {}, not comparing".format(baseline["implementation"]))
+        return regressions
+
+    limit = threshold / 100
+    for name, result in current["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        speed = result["ops_per_sec"] / old["ops_per_sec"] - 1
+        line = "{:24} {:+7.1f}% ops/s".format(name, speed * 100)
+        regressed = speed < -limit
+        if "peak_bytes" in old:
+            # Allow a few bytes of noise on operations that hardly allocate.
+            growth = result["peak_bytes"] - old["peak_bytes"]
+            line += " {:+9.1f} peak_bytes".format(growth)
+            if growth > max(old["peak_bytes"] * limit, 8):
+                regressed = True
+        print(line + (" REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def _shutdown() -> None:
+    # Lights() queues its frame clock on the event loop, which never runs
+    # here. Cancel those tasks so CPython does not warn about them.
+    import asyncio
+    loop = asyncio.get_event_loop_policy().get_event_loop()
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+
+
+def main(argv: List[str]) -> int:
+    options = {"--output": None, "--compare": None, "--threshold": "10", "--filter": None, "--scale": "1"}
+    i = 0
+    while i < len(argv):
+        if argv[i] not in options or i + 1 >= len(argv):
+            print("usage: run.py [--output FILE] [--compare FILE] [--threshold PCT] [--filter TEXT] [--scale N]")
+            return 2
+        options[argv[i]] = argv[i + 1]
+        i += 2
+
+    try:
+        current = run(options["--filter"], float(options["--scale"] or 1))
+    finally:
+        _shutdown()
+
+    output = options["--output"]
+    if output:
+        with open(output, "w") as file:
+            json.dump(current, file)
+
+    baseline_file = options["--compare"]
+    if baseline_file:
+        with open(baseline_file) as file:
+            baseline = json.load(file)
+        regressions = compare(current, baseline, float(options["--threshold"] or 10))
+        if regressions:
+            print("{} regressions: {}".format(len(regressions), ", ".join(regressions)))
+            return 1
+    return 0
+
+
+sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,255 @@
+# The benchmarks run by bench/run.py. Each one sets up the firmware objects
+# it needs and returns an operation, op(i), that is timed over many calls.
+# Nothing here runs an event loop: coroutines are stepped by _run_sync(),
+# which is enough for code that never has to wait.
+import buttons
+import formats
+import lights
+import subscriptions
+
+try:
+    from typing import Any, Callable, Dict, List, Tuple
+    Op = Callable[[int], Any]
+except ImportError:
+    pass
+
+
+def _run_sync(coro: Any) -> Any:
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError("benchmark coroutine had to wait")
+
+
+async def _callback(topic: bytes, label: str, data: Any) -> None:
+    pass
+
+
+# Subscriptions.message
+
+def _subscriptions(num_topics: int, wildcard: bool) -> Tuple[Any, List[bytes]]:
+    subs = subscriptions.Subscriptions(None)
+    topics = []
+    for i in range(num_topics):
+        topic = ["state", "Brian", "Light{}".format(i), "scenes"]
+        _run_sync(subs.subscribe(topic, "scenes", _callback, "json"))
+        topics.append("/".join(topic).encode('UTF8'))
+    if wildcard:
+        _run_sync(subs.subscribe(["state", "+", "+", "scenes"], "any", _callback, "raw"))
+    return subs, topics
+
+
+def message(num_topics: int, wildcard: bool = False) -> Op:
+    # num_topics topics with one callback each: the cost of finding the
+    # subscription, which should not grow with num_topics.
+    subs, topics = _subscriptions(num_topics, wildcard)
+    payload = b'["auto", "night"]'
+
+    def op(i: int) -> None:
+        _run_sync(subs.message(topics[i % num_topics], payload, False))
+    return op
+
+
+def message_subscribers(num_subscribers: int) -> Op:
+    # One topic with num_subscribers callbacks, all sharing the decoded
+    # payload.
+    subs = subscriptions.Subscriptions(None)
+    topic = ["state", "Brian", "Light", "scenes"]
+    for i in range(num_subscribers):
+        _run_sync(subs.subscribe(topic, str(i), _callback, "json"))
+    topic_bytes = "/".join(topic).encode('UTF8')
+    payload = b'["auto", "night"]'
+
+    def op(i: int) -> None:
+        _run_sync(subs.message(topic_bytes, payload, False))
+    return op
+
+
+def message_unmatched(num_topics: int) -> Op:
+    subs, _ = _subscriptions(num_topics, False)
+
+    def op(i: int) -> None:
+        _run_sync(subs.message(b"state/Kitchen/Light/scenes", b'["auto"]', False))
+    return op
+
+
+# Display state
+
+CONFIGS = {
+    "light": buttons.Config(
+        name="Brian", id="0", location="Brian", device="Light", type="light", action="toggle",
+        params={"scene": "auto", "priority": 100}),
+    "switch": buttons.Config(
+        name="Fan", id="1", location="Brian", device="Fan", type="switch", action="toggle", params={}),
+    "group": buttons.Config(
+        name="All", id="2", location="Brian", device="All", type="group", action="toggle",
+        params={"scene": "auto", "priority": 100, "devices": [["Brian", "Light"], ["Dining", "Light"]]}),
+}
+
+STATES = {
+    "light": [("power", "ON"), ("scenes", ["auto"]), ("priorities", [100])],
+    "switch": [("power", "ON")],
+    "group": [("0", ["auto"]), ("1", ["auto"])],
+}
+
+CHANGES = {
+    "light": [("scenes", ["auto"]), ("scenes", ["dim"]), ("scenes", ["auto", "rainbow"]), ("scenes", [])],
+    "switch": [("power", "ON"), ("power", "OFF")],
+    "group": [("1", ["auto"]), ("1", [])],
+}
+
+
+def _button(type: str) -> Any:
+    button = buttons.get_button_controller(CONFIGS[type])
+    for label, data in STATES[type]:
+        button.receive(label, data)
+    return button
+
+
+def compute_display_state(type: str) -> Op:
+    button = _button(type)
+
+    def op(i: int) -> None:
+        button._compute_display_state()
+    return op
+
+
+def receive(type: str) -> Op:
+    # A state message and the display state lookup that follows it.
+    button = _button(type)
+    changes = CHANGES[type]
+
+    def op(i: int) -> None:
+        label, data = changes[i % len(changes)]
+        button.receive(label, data)
+        button.get_shown_state()
+    return op
+
+
+# Lights
+
+class _Pin:
+    pass
+
+
+def _lights() -> Any:
+    strip = lights.Lights(_Pin())
+    strip._np.record = False
+    background = strip.create_task(lights.LightsTaskButtonColor)
+    for number in range(4):
+        background.set_button_colors(number, [(0, 1, 0), (0, 0, 0), (0, 1, 0), (0, 0, 0)])
+    strip._tick(0)
+    return strip
+
+
+def animation(start: Callable[[Any], None]) -> Op:
+    # One frame clock tick per call, restarting the animation whenever it
+    # finishes. The clock is moved on a second per tick, so every tick
+    # draws a frame.
+    strip = _lights()
+    now = [0]
+
+    def op(i: int) -> None:
+        if not strip._animations:
+            start(strip)
+        now[0] += 1000
+        strip._tick(now[0])
+    return op
+
+
+def _rotate(strip: Any) -> None:
+    strip.create_task(lights.LightsTask).rotate((0, 0, 31), 0.1)
+
+
+def _flash(strip: Any) -> None:
+    strip.create_task(lights.LightsTaskStatus).set_warn()
+
+
+def _boot(strip: Any) -> None:
+    strip.create_task(lights.LightsTaskBoot).set_boot()
+
+
+def _timer(strip: Any) -> None:
+    strip.create_task(lights.LightsTaskTimer).set_timer(7)
+
+
+def _error(strip: Any) -> None:
+    strip.create_task(lights.LightsTaskStatus).set_error(3)
+
+
+def fill() -> Op:
+    strip = _lights()
+    task = strip.create_task(lights.LightsTask)
+    colors = [(31, 0, 0), (0, 31, 0)]
+
+    def op(i: int) -> None:
+        task.fill(colors[i & 1])
+        strip._show()
+    return op
+
+
+def button_colors() -> Op:
+    strip = _lights()
+    task = strip.create_task(lights.LightsTaskButtonColor)
+    colors = [[(0, 1, 0)] * 4, [(0, 0, 1)] * 4]
+
+    def op(i: int) -> None:
+        task.set_button_colors(i & 3, colors[i & 1])
+        strip._tick(0)
+    return op
+
+
+# Publishing
+
+def encode(format: str) -> Op:
+    message = {"scene": "auto", "priority": 100, "action": "turn_off"}
+
+    def op(i: int) -> None:
+        formats.encode(message, format)
+    return op
+
+
+def decode(format: str) -> Op:
+    payload = formats.encode(["auto", "night", "rainbow"], format)
+
+    def op(i: int) -> None:
+        formats.decode(payload, format)
+    return op
+
+
+def command() -> Op:
+    def op(i: int) -> None:
+        buttons.Command("Brian", "Light", {"scene": "auto", "priority": 100})
+    return op
+
+
+# name: (factory, calls per run). Factories are called once per run.
+BENCHMARKS: Dict[str, Tuple[Callable[[], Op], int]] = {
+    "message_1": (lambda: message(1), 5000),
+    "message_16": (lambda: message(16), 5000),
+    "message_64": (lambda: message(64), 5000),
+    "message_16_wildcard": (lambda: message(16, True), 2000),
+    "message_subscribers_1": (lambda: message_subscribers(1), 5000),
+    "message_subscribers_16": (lambda: message_subscribers(16), 2000),
+    "message_subscribers_64": (lambda: message_subscribers(64), 500),
+    "message_unmatched_16": (lambda: message_unmatched(16), 5000),
+    "display_state_light": (lambda: compute_display_state("light"), 10000),
+    "display_state_switch": (lambda: compute_display_state("switch"), 10000),
+    "display_state_group": (lambda: compute_display_state("group"), 10000),
+    "receive_light": (lambda: receive("light"), 5000),
+    "receive_switch": (lambda: receive("switch"), 5000),
+    "receive_group": (lambda: receive("group"), 5000),
+    "frame_rotate": (lambda: animation(_rotate), 2000),
+    "frame_flash": (lambda: animation(_flash), 2000),
+    "frame_boot": (lambda: animation(_boot), 2000),
+    "frame_timer": (lambda: animation(_timer), 2000),
+    "frame_error": (lambda: animation(_error), 2000),
+    "lights_fill": (fill, 2000),
+    "lights_button_colors": (button_colors, 2000),
+    "publish_encode_json": (lambda: encode("json"), 5000),
+    "publish_encode_cbor": (lambda: encode("cbor"), 5000),
+    "decode_json": (lambda: decode("json"), 5000),
+    "decode_cbor": (lambda: decode("cbor"), 5000),
+    "command": (command, 2000),
+}
@@ -0,0 +1,6 @@
+# Runs the firmware on a Linux box under CPython, for profiling and for
+# trying changes without flashing a device. See harness.Harness.
+from host.broker import Broker, Device
+from host.harness import Harness
+
+__all__ = ["Broker", "Device", "Harness"]
@@ -0,0 +1,31 @@
+# A smoke run of the firmware on the host: boots it against simulated
+# devices, clicks each button and reports what happened.
+#
+#     python3 -m host
+import json
+
+from typing import Any, Dict
+
+from host import Broker, Harness
+
+
+async def scenario(harness: Harness) -> Dict[str, Any]:
+    harness.add_devices()
+    ready_s = await harness.ready()
+    for button in ("UL", "LL", "LR", "UR"):
+        await harness.press(button)
+        await harness.settle(700)
+    return {
+        "ready_ms": int(ready_s * 1000),
+        "frames": len(harness.strip.frames),
+        "broker": harness.broker.stats(),
+        "latency": harness.module("tracing").tracer.stats(),
+    }
+
+
+def main() -> None:
+    harness = Harness(Broker(latency_ms=2), quiet=True)
+    print(json.dumps(harness.run(scenario, timeout=30), indent=2))
+
+
+main()
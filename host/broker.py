@@ -0,0 +1,170 @@
+import asyncio
+import json
+import time
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+Listener = Callable[[bytes, bytes, bool], Any]
+
+
+def _levels(topic: bytes) -> List[bytes]:
+    return topic.split(b"/")
+
+
+def filter_matches(topic_filter: bytes, topic: bytes) -> bool:
+    filter_levels = _levels(topic_filter)
+    topic_levels = _levels(topic)
+    if topic_levels[0].startswith(b"$") and filter_levels[0] in (b"+", b"#"):
+        return False
+    for i, level in enumerate(filter_levels):
+        if level == b"#":
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != b"+" and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+# A subscriber on the broker side, for code in the harness rather than a
+# client under test.
+class _Listener:
+    def __init__(self, callback: Listener) -> None:
+        self._callback = callback
+
+    def deliver(self, topic: bytes, payload: bytes, retained: bool) -> None:
+        self._callback(topic, payload, retained)
+
+
+# An MQTT broker in the same process as its clients. Clients are anything
+# with a deliver(topic, payload, retained) method; messages are delivered
+# from the event loop after latency_ms, never from inside publish(), as
+# they would be over a network. Each client gets a message at most once,
+# however many of its filters match.
+class Broker:
+    def __init__(self, latency_ms: float = 0) -> None:
+        self.latency_ms = latency_ms
+        self.retained: Dict[bytes, bytes] = {}
+        self.published: List[Tuple[float, bytes, bytes, bool]] = []
+        self.record = True
+        self.publishes = 0
+        self.deliveries = 0
+        self.match_s = 0.0
+        self.in_flight = 0
+        self._subscriptions: List[Tuple[bytes, Any]] = []
+
+    def connect(self, client: Any) -> None:
+        pass
+
+    def disconnect(self, client: Any) -> None:
+        self._subscriptions = [(f, c) for f, c in self._subscriptions if c is not client]
+
+    async def round_trip(self) -> None:
+        await asyncio.sleep(self.latency_ms * 2 / 1000)
+
+    def subscribe(self, client: Any, topic_filter: bytes) -> None:
+        if (topic_filter, client) not in self._subscriptions:
+            self._subscriptions.append((topic_filter, client))
+        for topic, payload in self.retained.items():
+            if filter_matches(topic_filter, topic):
+                self._deliver(client, topic, payload, True)
+
+    def unsubscribe(self, client: Any, topic_filter: bytes) -> None:
+        self._subscriptions = [
+            (f, c) for f, c in self._subscriptions if not (f == topic_filter and c is client)]
+
+    def listen(self, topic_filter: str, callback: Listener) -> None:
+        # Call callback for every message matching topic_filter.
+        self.subscribe(_Listener(callback), topic_filter.encode('UTF8'))
+
+    def publish(self, topic: bytes, payload: bytes, retain: bool = False) -> None:
+        now = time.monotonic()
+        self.publishes += 1
+        if self.record:
+            self.published.append((now, topic, payload, retain))
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+
+        clients: List[Any] = []
+        for topic_filter, client in self._subscriptions:
+            if client not in clients and filter_matches(topic_filter, topic):
+                clients.append(client)
+        self.match_s += time.monotonic() - now
+
+        for client in clients:
+            self._deliver(client, topic, payload, False)
+
+    def _deliver(self, client: Any, topic: bytes, payload: bytes, retained: bool) -> None:
+        self.deliveries += 1
+        self.in_flight += 1
+        loop = asyncio.get_event_loop()
+        if self.latency_ms:
+            loop.call_later(self.latency_ms / 1000, self._arrive, client, topic, payload, retained)
+        else:
+            loop.call_soon(self._arrive, client, topic, payload, retained)
+
+    def _arrive(self, client: Any, topic: bytes, payload: bytes, retained: bool) -> None:
+        self.in_flight -= 1
+        client.deliver(topic, payload, retained)
+
+    def messages(self, topic_filter: str) -> List[Tuple[float, bytes, bytes, bool]]:
+        # Published messages matching topic_filter, oldest first.
+        encoded = topic_filter.encode('UTF8')
+        return [entry for entry in self.published if filter_matches(encoded, entry[1])]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "subscriptions": len(self._subscriptions),
+            "retained": len(self.retained),
+            "publishes": self.publishes,
+            "deliveries": self.deliveries,
+            "in_flight": self.in_flight,
+            "match_us": int(self.match_s * 1000000),
+        }
+
+
+# A robotica device answering commands the way the real ones do, so a
+# press can be followed through to the state it causes. Light commands
+# with a scene add or remove that scene; commands without one switch the
+# power.
+class Device:
+    def __init__(
+            self, broker: Broker, location: str, device: str,
+            scenes: Optional[List[str]] = None, power: str = "OFF") -> None:
+        self._broker = broker
+        self.prefix = "state/{}/{}/".format(location, device)
+        self.power = power
+        self.scenes: Dict[str, int] = {}
+        for scene in scenes or []:
+            self.scenes[scene] = 100
+        self.commands = 0
+        broker.listen("command/{}/{}".format(location, device), self._command)
+        self.publish()
+
+    def _command(self, topic: bytes, payload: bytes, retained: bool) -> None:
+        self.commands += 1
+        command = json.loads(payload)
+        action = command.get("action", "turn_on")
+        scene = command.get("scene")
+        if scene is None:
+            self.power = "ON" if action == "turn_on" else "OFF"
+            if action != "turn_on":
+                self.scenes = {}
+        else:
+            if action == "turn_off":
+                self.scenes.pop(scene, None)
+            else:
+                self.scenes[scene] = command.get("priority", 100)
+            self.power = "ON" if self.scenes else "OFF"
+        self.publish()
+
+    def publish(self) -> None:
+        scenes = list(self.scenes.keys())
+        priorities = list(self.scenes.values())
+        self._broker.publish((self.prefix + "power").encode('UTF8'), self.power.encode('UTF8'), True)
+        self._broker.publish((self.prefix + "scenes").encode('UTF8'), json.dumps(scenes).encode('UTF8'), True)
+        self._broker.publish(
+            (self.prefix + "priorities").encode('UTF8'), json.dumps(priorities).encode('UTF8'), True)
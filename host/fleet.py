@@ -0,0 +1,271 @@
+# Load test for a house full of remotes: N virtual remotes in one process,
+# all talking to one in-process broker and one set of simulated devices.
+#
+#     python3 -m host.fleet [--sizes 1,5,10,25,50] [--rounds 20]
+#                           [--latency-ms 1] [--battery-s 60] [--output FILE]
+#
+# Each remote runs the real buttons, subscriptions and queues code with its
+# own button_configs, wired up the way main() does it but without lights or
+# pins. Remotes overlap: neighbouring remotes control some of the same
+# devices, so a device's state is fanned out to several of them.
+#
+# For each fleet size, buttons on the remotes are pressed in turn. A press
+# is timed from sending its commands to each remote that watches the
+# device processing the resulting state, which is the state propagation
+# latency. The broker's deliveries per publish and time spent matching
+# filters show the cost of the fan-out.
+import asyncio
+import contextlib
+import io
+import json
+import sys
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from host.broker import Broker, Device
+from host.harness import install
+
+ROOMS = ["Brian", "Dining", "Kitchen", "Lounge", "Bathroom", "Guest", "Study", "Hall"]
+SWITCH_ROOMS = ["Brian", "Lounge"]
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def button_configs(buttons: Any, index: int) -> List[Any]:
+    # Four buttons for remote index: the lights in its own room and the next
+    # one, a fan, and a group of two lights.
+    room = ROOMS[index % len(ROOMS)]
+    next_room = ROOMS[(index + 1) % len(ROOMS)]
+    other_room = ROOMS[(index + 2) % len(ROOMS)]
+    switch_room = SWITCH_ROOMS[index % len(SWITCH_ROOMS)]
+    return [
+        buttons.Config(
+            name=room, id="0", location=room, device="Light", type="light", action="toggle",
+            params={"scene": "auto", "priority": 100}),
+        buttons.Config(
+            name=next_room, id="1", location=next_room, device="Light", type="light", action="turn_on",
+            params={"scene": "auto", "priority": 100}),
+        buttons.Config(
+            name="Fan", id="2", location=switch_room, device="Fan", type="switch", action="toggle",
+            params={}),
+        buttons.Config(
+            name="Both", id="3", location=room, device="Both", type="group", action="toggle",
+            params={"scene": "auto", "priority": 100, "devices": [[room, "Light"], [other_room, "Light"]]}),
+    ]
+
+
+def _targets(config: Any) -> List[Tuple[str, str]]:
+    if "devices" in config.params:
+        return [(location, device) for location, device in config.params["devices"]]
+    return [(config.location, config.device)]
+
+
+# The part of main() that deals with MQTT and buttons, for one remote.
+class VirtualRemote:
+    def __init__(self, fleet: 'Fleet', name: str, configs: List[Any]) -> None:
+        mqtt_as = sys.modules["mqtt_as"]
+        buttons = sys.modules["buttons"]
+        queues = sys.modules["queues"]
+        subscriptions = sys.modules["subscriptions"]
+
+        self.fleet = fleet
+        self.name = name
+        config = dict(mqtt_as.config)
+        config['client_id'] = name.encode('UTF8')
+        config['subs_cb'] = self._callback
+        config['connect_coro'] = self._conn_han
+        config['broker'] = fleet.broker
+        self.client = mqtt_as.MQTTClient(config)
+        self.subscriptions = subscriptions.Subscriptions(self.client)
+        self.inbound = queues.InboundQueue(32, self.subscriptions.message)
+        self.outbound = queues.OutboundQueue(16, self.client)
+        self.buttons = [buttons.get_button_controller(config) for config in configs]
+        self._tasks: List[asyncio.Task[Any]] = []
+
+    def _callback(self, topic: bytes, message: bytes, retained: bool) -> None:
+        self.inbound.put(topic, message, retained)
+
+    async def _conn_han(self, client: Any) -> None:
+        await self.subscriptions.connected()
+
+    async def _receive(self, config: Any, topic: bytes, label: str, data: Any) -> None:
+        button = self.buttons[int(config.id)]
+        button.receive(label, data)
+        self.fleet.arrived(self, topic)
+
+    async def start(self) -> None:
+        buttons = sys.modules["buttons"]
+        loop = asyncio.get_event_loop()
+        self._tasks.append(loop.create_task(self.inbound.run()))
+        self._tasks.append(loop.create_task(self.outbound.run()))
+        self._tasks.append(loop.create_task(self._battery()))
+        await self.client.connect()
+        for button in self.buttons:
+            await buttons.subscribe_topics(button, self.subscriptions, self._receive)
+        await self.subscriptions.flush()
+
+    async def _battery(self) -> None:
+        topic = "battery/{}".format(self.name).encode('UTF8')
+        while True:
+            await asyncio.sleep(self.fleet.battery_s)
+            self.outbound.put(topic, b"3300")
+
+    async def press(self, button: Any) -> None:
+        commands = button.get_press_commands()
+        button.predict(commands)
+        for command in commands:
+            self.outbound.put(command.topic, command.payload, command.key)
+        await self.outbound.flushed()
+
+    def watches(self, prefix: bytes) -> bool:
+        return any(
+            ("state/{}/{}/".format(*target)).encode('UTF8') == prefix
+            for button in self.buttons for target in _targets(button.config))
+
+    def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self.client.close()
+
+
+class Fleet:
+    def __init__(self, size: int, latency_ms: float = 1, battery_s: float = 60) -> None:
+        self.size = size
+        self.battery_s = battery_s
+        self.broker = Broker(latency_ms)
+        self.broker.record = False
+        self.remotes: List[VirtualRemote] = []
+        self._prefix: Optional[bytes] = None
+        self._sent = 0.0
+        self._arrivals: Dict[str, float] = {}
+
+    def arrived(self, remote: VirtualRemote, topic: bytes) -> None:
+        if self._prefix is not None and topic.startswith(self._prefix) and remote.name not in self._arrivals:
+            self._arrivals[remote.name] = time.perf_counter() - self._sent
+
+    async def run(self, rounds: int) -> Dict[str, Any]:
+        buttons = sys.modules["buttons"]
+        for room in ROOMS:
+            Device(self.broker, room, "Light", scenes=["auto"] if room in ROOMS[::2] else [])
+        for room in SWITCH_ROOMS:
+            Device(self.broker, room, "Fan")
+
+        self.remotes = [
+            VirtualRemote(self, "remote{}".format(i), button_configs(buttons, i)) for i in range(self.size)]
+        start = time.perf_counter()
+        await asyncio.gather(*(remote.start() for remote in self.remotes))
+        # Wait for the retained burst to be delivered and processed.
+        while self.broker.in_flight or any(len(remote.inbound) for remote in self.remotes):
+            await asyncio.sleep(0.001)
+        ready_s = time.perf_counter() - start
+
+        publishes = self.broker.publishes
+        deliveries = self.broker.deliveries
+        match_s = self.broker.match_s
+        cpu = time.process_time()
+        latencies: List[float] = []
+        converged: List[float] = []
+        missed = 0
+
+        for i in range(rounds):
+            remote = self.remotes[i % self.size]
+            button = remote.buttons[i % len(remote.buttons)]
+            # Follow the first device the button controls.
+            location, device = _targets(button.config)[0]
+            prefix = "state/{}/{}/".format(location, device).encode('UTF8')
+            watchers = [other.name for other in self.remotes if other.watches(prefix)]
+
+            self._prefix = prefix
+            self._arrivals = {}
+            self._sent = time.perf_counter()
+            await remote.press(button)
+            deadline = self._sent + 5
+            while len(self._arrivals) < len(watchers) and time.perf_counter() < deadline:
+                await asyncio.sleep(0.0005)
+            self._prefix = None
+
+            missed += len(watchers) - len(self._arrivals)
+            latencies.extend(self._arrivals.values())
+            if self._arrivals:
+                converged.append(max(self._arrivals.values()))
+            # Let the rest of the state messages settle before the next press.
+            await asyncio.sleep(0.01)
+
+        cpu = time.process_time() - cpu
+        publishes = self.broker.publishes - publishes
+        deliveries = self.broker.deliveries - deliveries
+        match_s = self.broker.match_s - match_s
+        subscriptions = self.broker.stats()["subscriptions"]
+        for remote in self.remotes:
+            remote.stop()
+
+        return {
+            "remotes": self.size,
+            "subscriptions": subscriptions,
+            "ready_s": ready_s,
+            "rounds": rounds,
+            "latency_ms": {
+                "p50": _percentile(latencies, 0.5) * 1000,
+                "p95": _percentile(latencies, 0.95) * 1000,
+                "max": max(latencies) * 1000 if latencies else 0,
+            },
+            "converged_ms": {
+                "p50": _percentile(converged, 0.5) * 1000,
+                "p95": _percentile(converged, 0.95) * 1000,
+            },
+            "missed": missed,
+            "publishes": publishes,
+            "deliveries": deliveries,
+            "deliveries_per_publish": deliveries / publishes if publishes else 0,
+            "match_us_per_publish": match_s * 1000000 / publishes if publishes else 0,
+            "cpu_ms_per_round": cpu * 1000 / rounds if rounds else 0,
+        }
+
+
+def run_fleet(size: int, rounds: int, latency_ms: float = 1, battery_s: float = 60) -> Dict[str, Any]:
+    install()
+    for name in ("mqtt_as", "buttons", "queues", "subscriptions"):
+        __import__(name)
+    fleet = Fleet(size, latency_ms, battery_s)
+    with contextlib.redirect_stdout(io.StringIO()):
+        result: Dict[str, Any] = asyncio.run(fleet.run(rounds))
+    return result
+
+
+def main(argv: List[str]) -> int:
+    options = {"--sizes": "1,5,10,25,50", "--rounds": "20", "--latency-ms": "1", "--battery-s": "60", "--output": ""}
+    i = 0
+    while i < len(argv):
+        if argv[i] not in options or i + 1 >= len(argv):
+            print("usage: python3 -m host.fleet [--sizes 1,5,10] [--rounds N] [--latency-ms MS] "
+                  "[--battery-s S] [--output FILE]")
+            return 2
+        options[argv[i]] = argv[i + 1]
+        i += 2
+
+    results = []
+    print("{:>7} {:>6} {:>8} {:>8} {:>8} {:>10} {:>12} {:>10}".format(
+        "remotes", "subs", "ready_s", "p50_ms", "p95_ms", "conv95_ms", "deliv/pub", "match_us"))
+    for size in [int(size) for size in options["--sizes"].split(",")]:
+        result = run_fleet(
+            size, int(options["--rounds"]), float(options["--latency-ms"]), float(options["--battery-s"]))
+        results.append(result)
+        print("{:7} {:6} {:8.3f} {:8.2f} {:8.2f} {:10.2f} {:12.1f} {:10.1f}".format(
+            result["remotes"], result["subscriptions"], result["ready_s"],
+            result["latency_ms"]["p50"], result["latency_ms"]["p95"], result["converged_ms"]["p95"],
+            result["deliveries_per_publish"], result["match_us_per_publish"]))
+
+    if options["--output"]:
+        with open(options["--output"], "w") as file:
+            json.dump(results, file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
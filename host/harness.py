@@ -0,0 +1,227 @@
+import asyncio
+import contextlib
+import importlib
+import io
+import os
+import sys
+import time
+import types
+
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar, Union
+
+from host.broker import Broker, Device
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+RUNTIME = os.path.join(ROOT, "host", "runtime")
+
+# The pins main() wires the buttons, lights and battery to.
+BUTTON_PINS = {"UL": 33, "LL": 27, "LR": 12, "UR": 15}
+LIGHTS_PIN = 13
+BATTERY_PIN = 35
+
+T = TypeVar("T")
+Scenario = Callable[["Harness"], Awaitable[T]]
+Payload = Union[str, bytes]
+
+
+def install() -> None:
+    # Make the stand-ins and the firmware importable, stand-ins first.
+    for path in (SRC, RUNTIME):
+        if path in sys.path:
+            sys.path.remove(path)
+        sys.path.insert(0, path)
+
+
+def _purge() -> None:
+    # Forget every firmware and stand-in module, so each run starts from
+    # a freshly booted device.
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None) or ""
+        if path.startswith(SRC + os.sep) or path.startswith(RUNTIME + os.sep):
+            del sys.modules[name]
+
+
+def _encode(value: Payload) -> bytes:
+    return value.encode('UTF8') if isinstance(value, str) else value
+
+
+# Runs the real main.py against the stand-ins in host/runtime, with a
+# scenario coroutine alongside it. The scenario drives the buttons and the
+# broker, and the run ends when it returns:
+#
+#     async def scenario(harness):
+#         await harness.ready()
+#         await harness.press("UL")
+#         await harness.settle()
+#         return harness.strip.pixels()
+#
+#     pixels = Harness().run(scenario)
+class Harness:
+    def __init__(
+            self, broker: Optional[Broker] = None, config: Optional[Dict[str, Any]] = None,
+            quiet: bool = False) -> None:
+        self.broker = broker if broker is not None else Broker()
+        self.config = config if config is not None else {}
+        self.quiet = quiet
+        self.output = ""
+        self.main: Optional[types.ModuleType] = None
+
+    def module(self, name: str) -> Any:
+        # A firmware or stand-in module, as loaded for the current run.
+        return sys.modules[name]
+
+    @property
+    def strip(self) -> Any:
+        return self.module("neopixel").NeoPixel.strips[0]
+
+    @property
+    def client(self) -> Any:
+        return self.module("mqtt_as").MQTTClient.clients[0]
+
+    @property
+    def mqtt(self) -> Any:
+        # main()'s MQTT object, found through the callback it gave the client.
+        return self.client._subs_cb.__self__
+
+    @property
+    def adc(self) -> Any:
+        return self.module("machine").ADC.adcs[BATTERY_PIN]
+
+    def pin(self, button: str) -> Any:
+        return self.module("machine").Pin.pins[BUTTON_PINS[button]]
+
+    def run(self, scenario: Scenario[T], timeout: Optional[float] = None) -> T:
+        install()
+        _purge()
+
+        mqtt_as: Any = importlib.import_module("mqtt_as")
+        mqtt_as.broker = self.broker
+        mqtt_as.config.update(self.config)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        result: List[T] = []
+        errors: List[BaseException] = []
+
+        async def wrapper() -> None:
+            try:
+                result.append(await asyncio.wait_for(scenario(self), timeout))
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                # Let the firmware's tasks unwind before main() closes the loop.
+                me = asyncio.current_task()
+                tasks = [task for task in asyncio.all_tasks() if task is not me]
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                loop.stop()
+
+        loop.create_task(wrapper())
+
+        main = types.ModuleType("main")
+        main.__file__ = os.path.join(SRC, "main.py")
+        sys.modules["main"] = main
+        self.main = main
+        with open(main.__file__) as file:
+            code = compile(file.read(), main.__file__, "exec")
+
+        output = io.StringIO()
+        redirect = contextlib.redirect_stdout(output) if self.quiet else contextlib.nullcontext()
+        try:
+            with redirect:
+                # main.py calls main() itself, which runs the loop until the
+                # scenario stops it.
+                exec(code, main.__dict__)
+        finally:
+            self.output = output.getvalue()
+            asyncio.set_event_loop(None)
+
+        if errors:
+            raise errors[0]
+        return result[0]
+
+    def add_devices(self) -> Dict[Tuple[str, str], Device]:
+        # Simulate every device main.py's buttons talk to. Call this at the
+        # start of the scenario, before the firmware has subscribed, so the
+        # devices' retained state is there to be sent.
+        assert self.main is not None
+        devices: Dict[Tuple[str, str], Device] = {}
+        for config in self.main.button_configs:
+            targets = [(config.location, config.device)]
+            targets.extend(tuple(target) for target in config.params.get("devices", []))
+            for location, device in targets:
+                if (location, device) not in devices:
+                    devices[(location, device)] = Device(self.broker, location, device)
+        return devices
+
+    def expected_filters(self) -> List[str]:
+        # Every filter main() subscribes to for its button_configs.
+        assert self.main is not None
+        buttons = self.module("buttons")
+        filters = []
+        for config in self.main.button_configs:
+            for topic, _, _ in buttons.get_button_controller(config).get_topics():
+                filters.append("/".join(topic))
+        return filters
+
+    async def ready(self, timeout: float = 5) -> float:
+        # Wait until the firmware has subscribed to everything and been
+        # sent the retained messages. Returns the seconds it took.
+        start = time.monotonic()
+        mqtt_as = self.module("mqtt_as")
+        expected = set(filter.encode('UTF8') for filter in self.expected_filters())
+        while True:
+            clients = mqtt_as.MQTTClient.clients
+            if clients and clients[0].isconnected() and expected <= set(clients[0].subscribed):
+                break
+            if time.monotonic() - start > timeout:
+                raise TimeoutError("firmware did not subscribe")
+            await asyncio.sleep(0.005)
+        await self.settle()
+        return time.monotonic() - start
+
+    async def settle(self, ms: float = 50) -> None:
+        await asyncio.sleep(ms / 1000)
+
+    async def press(self, button: str, hold_ms: float = 60, bounces: int = 0) -> None:
+        # A short click, with optional contact bounce on the way down.
+        pin = self.pin(button)
+        for _ in range(bounces):
+            pin.drive(0)
+            pin.drive(1)
+        pin.drive(0)
+        await asyncio.sleep(hold_ms / 1000)
+        pin.drive(1)
+
+    async def long_press(self, button: str, hold_ms: float = 800) -> None:
+        await self.press(button, hold_ms)
+
+    async def double_click(self, button: str, hold_ms: float = 60, gap_ms: float = 120) -> None:
+        await self.press(button, hold_ms)
+        await asyncio.sleep(gap_ms / 1000)
+        await self.press(button, hold_ms)
+
+    def inject(self, topic: str, payload: Payload, retain: bool = False) -> None:
+        # Publish to the broker, as another client would.
+        self.broker.publish(topic.encode('UTF8'), _encode(payload), retain)
+
+    async def inject_stream(
+            self, messages: Iterable[Tuple[str, Payload, bool]], interval_ms: float = 0) -> int:
+        # Publish each (topic, payload, retain) in turn, interval_ms apart.
+        count = 0
+        for topic, payload, retain in messages:
+            self.inject(topic, payload, retain)
+            count += 1
+            await asyncio.sleep(interval_ms / 1000)
+        return count
+
+    async def wait_for(self, condition: Callable[[], bool], timeout: float = 5) -> float:
+        # Poll until condition() is true; returns the seconds it took.
+        start = time.monotonic()
+        while not condition():
+            if time.monotonic() - start > timeout:
+                raise TimeoutError("condition not met")
+            await asyncio.sleep(0.001)
+        return time.monotonic() - start
@@ -0,0 +1,155 @@
+# Replays a capture recorded on a device (see src/recorder.py) through the
+# firmware running in the harness, and reports how long each message took
+# to process and how often the lights were written.
+#
+#     python3 -m host.replay CAPTURE [--speed 1|10|max] [--queue] [--output FILE]
+#
+# CAPTURE is the capture_path the device was configured with; copy both it
+# and CAPTURE.old off the device. By default every message goes straight
+# to Subscriptions.message, and on to main()'s callback, and is timed on
+# its own. With --queue messages are handed to the MQTT callback instead,
+# so they go through the inbound queue and are coalesced as on the device.
+import asyncio
+import json
+import sys
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from host.harness import Harness, install
+
+Entry = Tuple[int, bytes, bytes, bool]
+
+TICKS_MAX = (1 << 30) - 1
+TICKS_HALFPERIOD = 1 << 29
+
+
+def load(path: str) -> List[Entry]:
+    install()
+    import recorder
+    return list(recorder.read(path))
+
+
+def _ticks_diff(end: int, start: int) -> int:
+    return ((end - start + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Replay:
+    def __init__(self, entries: List[Entry], speed: Optional[float] = 1, queue: bool = False) -> None:
+        # speed None replays as fast as the firmware can take it.
+        self.entries = entries
+        self.speed = speed
+        self.queue = queue
+
+    async def _wait(self, start: float, offset_ms: int) -> None:
+        if self.speed is None:
+            # Still let the frame clock and queues run between messages.
+            await asyncio.sleep(0)
+            return
+        due = start + offset_ms / 1000 / self.speed
+        delay = due - time.monotonic()
+        await asyncio.sleep(delay if delay > 0 else 0)
+
+    async def scenario(self, harness: Harness) -> Dict[str, Any]:
+        await harness.ready()
+        mqtt = harness.mqtt
+        strip = harness.strip
+        writes = strip.writes
+        latencies: List[float] = []
+        topics: Dict[bytes, int] = {}
+
+        start = time.monotonic()
+        first = self.entries[0][0] if self.entries else 0
+        for ticks, topic, payload, retained in self.entries:
+            await self._wait(start, _ticks_diff(ticks, first))
+            topics[topic] = topics.get(topic, 0) + 1
+            if self.queue:
+                mqtt._callback(topic, payload, retained)
+                continue
+            begin = time.perf_counter()
+            await mqtt.subscriptions.message(topic, payload, retained)
+            latencies.append((time.perf_counter() - begin) * 1000000)
+
+        if self.queue:
+            await harness.wait_for(lambda: len(mqtt.inbound) == 0, timeout=60)
+        duration = time.monotonic() - start
+        # Give the frame clock time to show the last change.
+        await harness.settle(2 * 1000 / harness.module("lights").FPS)
+
+        led_writes = strip.writes - writes
+        span_ms = _ticks_diff(self.entries[-1][0], first) if self.entries else 0
+        result: Dict[str, Any] = {
+            "messages": len(self.entries),
+            "topics": len(topics),
+            "speed": self.speed if self.speed is not None else "max",
+            "capture_s": span_ms / 1000,
+            "replay_s": duration,
+            "led_writes": led_writes,
+            "led_writes_per_message": led_writes / len(self.entries) if self.entries else 0,
+            "busiest_topics": [
+                [topic.decode('UTF8'), count]
+                for topic, count in sorted(topics.items(), key=lambda item: -item[1])[:5]
+            ],
+        }
+        if self.queue:
+            result["inbound"] = mqtt.inbound.stats()
+        else:
+            result["latency_us"] = {
+                "mean": sum(latencies) / len(latencies) if latencies else 0,
+                "p50": _percentile(latencies, 0.5),
+                "p95": _percentile(latencies, 0.95),
+                "max": max(latencies) if latencies else 0,
+            }
+        return result
+
+    def run(self, harness: Optional[Harness] = None) -> Dict[str, Any]:
+        if harness is None:
+            harness = Harness(quiet=True)
+        result: Dict[str, Any] = harness.run(self.scenario)
+        return result
+
+
+def main(argv: List[str]) -> int:
+    speed: Optional[float] = 1
+    queue = False
+    output = None
+    paths = []
+    i = 0
+    while i < len(argv):
+        if argv[i] == "--speed" and i + 1 < len(argv):
+            speed = None if argv[i + 1] == "max" else float(argv[i + 1])
+            i += 2
+        elif argv[i] == "--output" and i + 1 < len(argv):
+            output = argv[i + 1]
+            i += 2
+        elif argv[i] == "--queue":
+            queue = True
+            i += 1
+        else:
+            paths.append(argv[i])
+            i += 1
+    if len(paths) != 1:
+        print("usage: python3 -m host.replay CAPTURE [--speed 1|10|max] [--queue] [--output FILE]")
+        return 2
+
+    entries = load(paths[0])
+    if not entries:
+        print("{}: no messages".format(paths[0]))
+        return 1
+    result = Replay(entries, speed, queue).run()
+    print(json.dumps(result, indent=2))
+    if output:
+        with open(output, "w") as file:
+            json.dump(result, file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
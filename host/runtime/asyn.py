@@ -0,0 +1,42 @@
+# Stand-in for Peter Hinch's asyn module: just the Event the firmware uses,
+# which can be awaited directly, and the coroutine type.
+import uasyncio as asyncio
+
+try:
+    from typing import Any
+except ImportError:
+    pass
+
+
+async def _coro() -> None:
+    pass
+
+
+_c = _coro()
+type_coro = type(_c)
+_c.close()
+
+
+class Event:
+    def __init__(self, delay_ms: int = 0) -> None:
+        self._event = asyncio.Event()
+        self._data: Any = None
+
+    def __await__(self) -> Any:
+        return self._event.wait().__await__()
+
+    __iter__ = __await__
+
+    def is_set(self) -> bool:
+        return bool(self._event.is_set())
+
+    def set(self, data: Any = None) -> None:
+        self._data = data
+        self._event.set()
+
+    def clear(self) -> None:
+        self._data = None
+        self._event.clear()
+
+    def value(self) -> Any:
+        return self._data
@@ -0,0 +1,4 @@
+# Host configuration; the harness fills in anything else it needs.
+from mqtt_as import config
+
+config['client_id'] = b'host'
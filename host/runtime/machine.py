@@ -0,0 +1,98 @@
+# Stand-in for the MicroPython machine module. Pins keep a level that the
+# harness drives; changing it calls the pin's interrupt handler directly,
+# as the hardware would.
+try:
+    from typing import Any, Callable, Dict, Optional
+except ImportError:
+    pass
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 2
+    PULL_DOWN = 1
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    # Every pin created, by id, so the harness can find the pins main()
+    # made for itself.
+    pins: Dict[Any, 'Pin'] = {}
+
+    def __init__(self, id: Any, mode: int = -1, pull: int = -1, value: Optional[int] = None) -> None:
+        self.id = id
+        self.mode = mode
+        self.pull = pull
+        if value is None:
+            value = 1 if pull == self.PULL_UP else 0
+        self._value = value
+        self._trigger = 0
+        self._handler: Optional[Callable[['Pin'], Any]] = None
+        Pin.pins[id] = self
+
+    def __repr__(self) -> str:
+        return "Pin({})".format(self.id)
+
+    def value(self, value: Optional[int] = None) -> int:
+        if value is not None:
+            self._value = 1 if value else 0
+        return self._value
+
+    def on(self) -> None:
+        self._value = 1
+
+    def off(self) -> None:
+        self._value = 0
+
+    def irq(self, handler: Optional[Callable[['Pin'], Any]] = None, trigger: int = 3) -> None:
+        self._handler = handler
+        self._trigger = trigger
+
+    def drive(self, level: int) -> None:
+        # Set the level from outside, firing the interrupt on an edge.
+        level = 1 if level else 0
+        if level == self._value:
+            return
+        self._value = level
+        edge = self.IRQ_RISING if level else self.IRQ_FALLING
+        if self._handler is not None and self._trigger & edge:
+            self._handler(self)
+
+
+# An analogue input whose reading is set by the harness.
+class ADC:
+    ATTN_0DB = 0
+    ATTN_2_5DB = 1
+    ATTN_6DB = 2
+    ATTN_11DB = 3
+
+    WIDTH_12BIT = 3
+
+    adcs: Dict[Any, 'ADC'] = {}
+
+    def __init__(self, pin: Pin) -> None:
+        self.pin = pin
+        self.attenuation = self.ATTN_0DB
+        self.reading = 0
+        ADC.adcs[pin.id] = self
+
+    def atten(self, attenuation: int) -> None:
+        self.attenuation = attenuation
+
+    def width(self, width: int) -> None:
+        pass
+
+    def read(self) -> int:
+        return self.reading
+
+    def read_u16(self) -> int:
+        return self.reading << 4
+
+
+def reset() -> None:
+    raise SystemExit("machine.reset()")
+
+
+def unique_id() -> bytes:
+    return b"host\x00\x00"
@@ -0,0 +1,91 @@
+# Stand-in for mqtt_as, talking to the in-process broker the harness sets
+# as broker. Messages from the broker arrive through the subs_cb callback,
+# as they would from the network.
+try:
+    from typing import Any, Awaitable, Callable, Dict, List, Union
+except ImportError:
+    pass
+
+
+async def eliza(*args: Any) -> None:
+    return
+
+
+config: Dict[str, Any] = {
+    'client_id': b'host',
+    'server': None,
+    'port': 0,
+    'user': '',
+    'password': '',
+    'keepalive': 60,
+    'ping_interval': 0,
+    'ssl': False,
+    'ssl_params': {},
+    'response_time': 10,
+    'clean_init': True,
+    'clean': True,
+    'max_repubs': 4,
+    'will': None,
+    'subs_cb': lambda *_: None,
+    'wifi_coro': eliza,
+    'connect_coro': eliza,
+    'ssid': None,
+    'wifi_pw': None,
+}
+
+# The host.broker.Broker clients connect to.
+broker: Any = None
+
+
+def _bytes(value: Union[str, bytes]) -> bytes:
+    return value.encode('UTF8') if isinstance(value, str) else bytes(value)
+
+
+class MQTTClient:
+    DEBUG = False
+
+    # Every client created, so the harness can find the one main() made.
+    clients: List['MQTTClient'] = []
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        self._subs_cb: Callable[[bytes, bytes, bool], Any] = config['subs_cb']
+        self._connect_coro: Callable[['MQTTClient'], Awaitable[None]] = config['connect_coro']
+        self._broker = config.get('broker', broker)
+        self._connected = False
+        self.client_id = config['client_id']
+        self.subscribed: List[bytes] = []
+        MQTTClient.clients.append(self)
+        if self._broker is None:
+            raise OSError("no broker")
+
+    async def connect(self) -> None:
+        self._broker.connect(self)
+        self._connected = True
+        await self._connect_coro(self)
+
+    def isconnected(self) -> bool:
+        return self._connected
+
+    async def subscribe(self, topic: Union[str, bytes], qos: int = 0) -> None:
+        await self._broker.round_trip()
+        self._broker.subscribe(self, _bytes(topic))
+        self.subscribed.append(_bytes(topic))
+
+    async def unsubscribe(self, topic: Union[str, bytes]) -> None:
+        await self._broker.round_trip()
+        self._broker.unsubscribe(self, _bytes(topic))
+
+    async def publish(
+            self, topic: Union[str, bytes], msg: Union[str, bytes], retain: bool = False, qos: int = 0) -> None:
+        if not self._connected:
+            raise OSError("not connected")
+        self._broker.publish(_bytes(topic), _bytes(msg), retain)
+
+    def deliver(self, topic: bytes, msg: bytes, retained: bool) -> None:
+        if self._connected:
+            self._subs_cb(topic, msg, retained)
+
+    def close(self) -> None:
+        if self._connected:
+            self._connected = False
+            self._broker.disconnect(self)
@@ -0,0 +1,55 @@
+# Stand-in for the MicroPython neopixel module. Every write() is recorded
+# as a frame, with the time it was written, so tests can see exactly what
+# the strip showed. Benchmarks turn recording off and just count writes.
+import utime
+
+try:
+    from typing import Any, List, Tuple
+except ImportError:
+    pass
+
+
+class NeoPixel:
+    ORDER = (1, 0, 2, 3)
+
+    strips: List['NeoPixel'] = []
+    record = True
+
+    def __init__(self, pin: Any, n: int, bpp: int = 3, timing: Any = 1) -> None:
+        self.pin = pin
+        self.n = n
+        self.bpp = bpp
+        self.timing = timing
+        self.buf = bytearray(n * bpp)
+        self.frames: List[Tuple[int, bytes]] = []
+        self.writes = 0
+        NeoPixel.strips.append(self)
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __setitem__(self, index: int, value: Tuple[int, ...]) -> None:
+        offset = index * self.bpp
+        for i in range(self.bpp):
+            self.buf[offset + self.ORDER[i]] = value[i]
+
+    def __getitem__(self, index: int) -> Tuple[int, ...]:
+        offset = index * self.bpp
+        return tuple(self.buf[offset + self.ORDER[i]] for i in range(self.bpp))
+
+    def fill(self, value: Tuple[int, ...]) -> None:
+        for index in range(self.n):
+            self[index] = value
+
+    def write(self) -> None:
+        self.writes += 1
+        if self.record:
+            self.frames.append((utime.ticks_ms(), bytes(self.buf)))
+
+    def pixels(self, frame: int = -1) -> List[Tuple[int, ...]]:
+        # The colours of a recorded frame, in (r, g, b) order.
+        buf = self.frames[frame][1]
+        return [
+            tuple(buf[index * self.bpp + self.ORDER[i]] for i in range(self.bpp))
+            for index in range(self.n)
+        ]
@@ -0,0 +1,15 @@
+# Stand-in for the micropython-lib uasyncio, on top of CPython's asyncio.
+# Only the parts of the old API the firmware uses are added.
+from asyncio import *  # noqa: F401,F403
+import asyncio as _asyncio
+
+
+def get_event_loop() -> _asyncio.AbstractEventLoop:  # type: ignore[no-redef]
+    try:
+        return _asyncio.get_running_loop()
+    except RuntimeError:
+        return _asyncio.get_event_loop_policy().get_event_loop()
+
+
+async def sleep_ms(ms: int) -> None:
+    await _asyncio.sleep(ms / 1000)
@@ -0,0 +1,39 @@
+# Stand-in for the MicroPython utime module, with the ESP32's 30 bit tick
+# counters so wrap around is exercised the same way.
+import time as _time
+
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+
+def ticks_ms() -> int:
+    return (_time.monotonic_ns() // 1000000) & TICKS_MAX
+
+
+def ticks_us() -> int:
+    return (_time.monotonic_ns() // 1000) & TICKS_MAX
+
+
+def ticks_diff(end: int, start: int) -> int:
+    return ((end - start + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+
+def ticks_add(ticks: int, delta: int) -> int:
+    return (ticks + delta) & TICKS_MAX
+
+
+def sleep(seconds: float) -> None:
+    _time.sleep(seconds)
+
+
+def sleep_ms(ms: int) -> None:
+    _time.sleep(ms / 1000)
+
+
+def sleep_us(us: int) -> None:
+    _time.sleep(us / 1000000)
+
+
+def time() -> int:
+    return int(_time.time())
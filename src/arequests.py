@@ -1,34 +1,275 @@
 # File copied from urequests.py from micropython-esp32 tree.
 
 import uasyncio as asyncio
+import utime
 
 try:
-    from typing import IO, Any, Dict, Optional
+    from typing import IO, Any, Dict, List, Optional, Tuple
 except ImportError:
     pass
 
 
+# An open connection to host:port, and when it was last put back in the
+# pool.
+class Connection:
+
+    def __init__(self, host: str, port: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.host = host
+        self.port = port
+        self.reader = reader
+        self.writer = writer
+        self.idle_since = utime.ticks_ms()
+        self.requests = 0
+
+    async def aclose(self) -> None:
+        try:
+            await self.writer.aclose()
+        except OSError:
+            pass
+
+
+# Keeps connections open between requests, so a request to a host that was
+# talked to recently skips the TCP handshake. At most max_per_host idle
+# connections are kept for each host, and one that has been idle for longer
+# than idle_timeout_ms is closed rather than used, as the server has most
+# likely given up on it by then.
+#
+# A connection goes back to the pool once the body of its response has been
+# read to the end, and only if the server agreed to keep it open.
+class ConnectionPool:
+
+    def __init__(self, max_per_host: int = 2, idle_timeout_ms: int = 30000) -> None:
+        self.max_per_host = max_per_host
+        self.idle_timeout_ms = idle_timeout_ms
+        self._idle: Dict[Tuple[str, int], List[Connection]] = {}
+        self.requests = 0
+        self.reused = 0
+        self.opened = 0
+        self.expired = 0
+        self.stale = 0
+        self.closed = 0
+
+    async def acquire(self, host: str, port: int) -> Tuple[Connection, bool]:
+        # Returns a connection to host:port, and whether it was reused.
+        self.requests += 1
+        idle = self._idle.get((host, port))
+        now = utime.ticks_ms()
+        while idle:
+            conn = idle.pop()
+            if utime.ticks_diff(now, conn.idle_since) < self.idle_timeout_ms:
+                self.reused += 1
+                return conn, True
+            self.expired += 1
+            await conn.aclose()
+        return await self.connect(host, port), False
+
+    async def connect(self, host: str, port: int) -> Connection:
+        reader, writer = await asyncio.open_connection(host, port)
+        self.opened += 1
+        return Connection(host, port, reader, writer)
+
+    async def discard(self, conn: Connection) -> None:
+        # A reused connection turned out to have been closed by the server.
+        self.reused -= 1
+        self.stale += 1
+        await conn.aclose()
+
+    async def release(self, conn: Connection, reusable: bool) -> None:
+        key = (conn.host, conn.port)
+        idle = self._idle.get(key)
+        if idle is None:
+            idle = []
+            self._idle[key] = idle
+        if reusable and len(idle) < self.max_per_host:
+            conn.idle_since = utime.ticks_ms()
+            idle.append(conn)
+        else:
+            self.closed += 1
+            await conn.aclose()
+
+    async def aclose(self) -> None:
+        for idle in self._idle.values():
+            while idle:
+                await idle.pop().aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "reused": self.reused,
+            "opened": self.opened,
+            "expired": self.expired,
+            "stale": self.stale,
+            "closed": self.closed,
+            "idle": sum(len(idle) for idle in self._idle.values()),
+            "hit_rate": self.reused / self.requests if self.requests else 0,
+        }
+
+
+# Requests that can be sent again if a reused connection turns out to have
+# been closed by the server.
+IDEMPOTENT = ("GET", "HEAD", "PUT", "DELETE")
+
+# Used by request() when it is not given a pool.
+default_pool = ConnectionPool()
+
+
 class Response:
 
-    def __init__(self, f: asyncio.StreamReader, status: int, reason: str) -> None:
+    def __init__(
+            self, f: asyncio.StreamReader, status: int, reason: str,
+            length: Optional[int] = None, chunked: bool = False,
+            conn: Optional[Connection] = None, pool: Optional[ConnectionPool] = None,
+            keep_alive: bool = False) -> None:
         self.raw = f
         self.encoding = "utf-8"
         self._cached = None  # type: Optional[bytes]
         self.status_code = status
         self.reason = reason
+        # Bytes of the body, or of the current chunk, still to be read. None
+        # if the body runs until the server closes the connection.
+        self._remaining = length
+        self._chunked = chunked
+        self._conn = conn
+        self._pool = pool
+        self._keep_alive = keep_alive and (chunked or length is not None)
+        if chunked:
+            self._remaining = 0
+
+    async def _finish(self, complete: bool) -> None:
+        # The body has been read, or abandoned: hand the connection back.
+        conn = self._conn
+        raw = self.raw
+        self._conn = None
+        self.raw = None
+        if conn is not None and self._pool is not None:
+            await self._pool.release(conn, complete and self._keep_alive)
+        elif raw is not None:
+            await raw.aclose()
+
+    async def _next_chunk(self) -> bool:
+        # Reads a chunk size line; False after the last chunk.
+        line = await self.raw.readline()
+        try:
+            size = int(line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise ValueError("Bad chunk size %r" % line)
+        if size == 0:
+            # Skip any trailers.
+            while True:
+                line = await self.raw.readline()
+                if not line or line == b"\r\n":
+                    break
+            return False
+        self._remaining = size
+        return True
+
+    async def _limit(self, size: int) -> int:
+        # How much of the body can be read next, at most size; 0 once it
+        # has all been read.
+        if self.raw is None:
+            return 0
+        if self._chunked and self._remaining == 0 and not await self._next_chunk():
+            await self._finish(True)
+            return 0
+        if self._remaining is not None:
+            size = min(size, self._remaining)
+            if size == 0:
+                await self._finish(True)
+        return size
+
+    async def _consumed(self, size: int) -> None:
+        if size == 0:
+            await self._finish(self._remaining is None)
+            if self._remaining is not None:
+                raise OSError("Connection closed with %d bytes to go" % self._remaining)
+            return
+        if self._remaining is not None:
+            self._remaining -= size
+            if self._chunked and self._remaining == 0:
+                await self.raw.readexactly(2)
+            elif self._remaining == 0:
+                await self._finish(True)
+
+    async def read(self, size: int) -> bytes:
+        # Up to size bytes of the body; b"" once it has all been read.
+        size = await self._limit(size)
+        if size == 0:
+            return b""
+        data = await self.raw.read(size)  # type: bytes
+        await self._consumed(len(data))
+        return data
+
+    async def readinto(self, buf: memoryview) -> int:
+        # Reads the next part of the body into buf, without allocating a
+        # bytes object for it where the stream can do that. Returns how
+        # many bytes were read, 0 once the body has all been read.
+        size = await self._limit(len(buf))
+        if size == 0:
+            return 0
+        if size < len(buf):
+            buf = buf[:size]
+        readinto = getattr(self.raw, "readinto", None)
+        if readinto is not None:
+            size = await readinto(buf)
+        else:
+            data = await self.raw.read(size)
+            size = len(data)
+            buf[:size] = data
+        await self._consumed(size)
+        return size
+
+    def iter_chunks(self, buf: memoryview) -> 'ChunkIterator':
+        # async for chunk in resp.iter_chunks(buf): each chunk is a slice of
+        # buf, only valid until the next one is read.
+        return ChunkIterator(self, buf)
+
+    def iter_json(self, buf: memoryview, max_item: int = 1024) -> 'JSONArrayIterator':
+        # async for item in resp.iter_json(buf): the items of a body that is
+        # a JSON array, one at a time, for arrays too big to hold in memory.
+        return JSONArrayIterator(self, buf, JSONArrayParser(max_item))
+
+    async def save(self, path: str, buf: Optional[memoryview] = None) -> int:
+        # Writes the body to the file at path, a buffer at a time. Returns
+        # the number of bytes written.
+        if buf is None:
+            buf = memoryview(bytearray(512))
+        written = 0
+        with open(path, "wb") as file:
+            while True:
+                size = await self.readinto(buf)
+                if not size:
+                    return written
+                file.write(buf[:size])
+                written += size
 
     async def aclose(self) -> None:
+        # Closes the connection unless the body has already been read.
         if self.raw:
-            await self.raw.aclose()
-            self.raw = None
+            await self._finish(False)
         self._cached = None
 
     async def content(self) -> bytes:
         if self._cached is None:
-            raw_data = await self.raw.read()  # type: bytes
-            self._cached = raw_data
-            await self.raw.aclose()
-            self.raw = None
+            if self.raw is None:
+                self._cached = b""
+            elif self._remaining is not None and not self._chunked:
+                # Known length: one allocation for the whole body.
+                raw_data = await self.raw.readexactly(self._remaining)  # type: bytes
+                self._remaining = 0
+                self._cached = raw_data
+                await self._finish(True)
+            elif self._chunked:
+                chunks = []
+                while True:
+                    chunk = await self.read(self._remaining or 1024)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                self._cached = b"".join(chunks)
+            else:
+                raw_data = await self.raw.read()
+                self._cached = raw_data
+                await self._finish(False)
             return self._cached
         else:
             return self._cached
@@ -41,11 +282,156 @@ class Response:
         return ujson.loads(await self.content())
 
 
+class ChunkIterator:
+
+    def __init__(self, response: Response, buf: memoryview) -> None:
+        self.response = response
+        self.buf = buf
+
+    def __aiter__(self) -> 'ChunkIterator':
+        return self
+
+    async def __anext__(self) -> memoryview:
+        size = await self.response.readinto(self.buf)
+        if not size:
+            raise StopAsyncIteration
+        return self.buf[:size]
+
+
+# Splits a JSON array fed to it in pieces into its items. Only the item
+# being read is held, in a buffer of max_item bytes, and each is decoded
+# with ujson as soon as it is complete. ValueError if the input is not an
+# array, or an item is longer than max_item.
+class JSONArrayParser:
+
+    def __init__(self, max_item: int = 1024) -> None:
+        self._buf = bytearray(max_item)
+        self._mv = memoryview(self._buf)
+        self._len = 0
+        # Nesting depth: 0 before the array, 1 between its items.
+        self._depth = 0
+        self._in_item = False
+        self._in_string = False
+        self._escape = False
+        self.done = False
+
+    def _append(self, data: memoryview) -> None:
+        size = len(data)
+        if self._len + size > len(self._buf):
+            raise ValueError("JSON array item longer than %d bytes" % len(self._buf))
+        self._mv[self._len:self._len + size] = data
+        self._len += size
+
+    def _item(self) -> Any:
+        import ujson
+        item = ujson.loads(bytes(self._mv[:self._len]))
+        self._len = 0
+        self._in_item = False
+        return item
+
+    def feed(self, data: memoryview) -> List[Any]:
+        # Returns the items completed by data.
+        items = []
+        start = 0
+        for i in range(len(data)):
+            c = data[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == 0x5c:  # \
+                    self._escape = True
+                elif c == 0x22:  # "
+                    self._in_string = False
+                continue
+            if c in b" \t\r\n":
+                continue
+            if self._depth == 0:
+                if c != 0x5b or self.done:  # [
+                    raise ValueError("Expected a JSON array")
+                self._depth = 1
+                continue
+            if self._depth == 1 and c in b",]":
+                if self._in_item:
+                    self._append(data[start:i])
+                    items.append(self._item())
+                if c == 0x5d:  # ]
+                    self._depth = 0
+                    self.done = True
+                continue
+            if not self._in_item:
+                self._in_item = True
+                start = i
+            if c == 0x22:
+                self._in_string = True
+            elif c in b"[{":
+                self._depth += 1
+            elif c in b"]}":
+                self._depth -= 1
+        if self._in_item:
+            self._append(data[start:])
+        return items
+
+
+class JSONArrayIterator:
+
+    def __init__(self, response: Response, buf: memoryview, parser: JSONArrayParser) -> None:
+        self.response = response
+        self.buf = buf
+        self.parser = parser
+        self._items: List[Any] = []
+        self._next = 0
+
+    def __aiter__(self) -> 'JSONArrayIterator':
+        return self
+
+    async def __anext__(self) -> Any:
+        while self._next >= len(self._items):
+            if self.parser.done:
+                # Read up to the end of the body, so the connection can be
+                # used again.
+                while await self.response.readinto(self.buf):
+                    pass
+                raise StopAsyncIteration
+            size = await self.response.readinto(self.buf)
+            if not size:
+                raise ValueError("JSON array not terminated")
+            self._items = self.parser.feed(self.buf[:size])
+            self._next = 0
+        item = self._items[self._next]
+        self._next += 1
+        return item
+
+
+async def _send(
+        conn: Connection, method: str, host: str, path: str,
+        data: Optional[bytes], headers: Dict[str, str]) -> None:
+    writer = conn.writer
+    await writer.awrite(b"%s /%s HTTP/1.1\r\n" % (method.encode(), path.encode()))
+    if "Host" not in headers:
+        await writer.awrite(b"Host: %s\r\n" % host.encode())
+    if "Connection" not in headers:
+        await writer.awrite(b"Connection: keep-alive\r\n")
+    # Iterate over keys to avoid tuple alloc
+    for k in headers:
+        await writer.awrite(k)
+        await writer.awrite(b": ")
+        await writer.awrite(headers[k])
+        await writer.awrite(b"\r\n")
+    if data:
+        await writer.awrite(b"Content-Length: %d\r\n" % len(data))
+    await writer.awrite(b"\r\n")
+    if data:
+        await writer.awrite(data)
+
+
 async def request(
         method: str, url: str,
         data: Optional[bytes] = None, json: Any = None,
         headers: Dict[str, str] = {},
-        stream: Optional[IO[bytes]] = None) -> Response:
+        stream: Optional[IO[bytes]] = None,
+        pool: Optional[ConnectionPool] = None) -> Response:
+    if pool is None:
+        pool = default_pool
     try:
         proto, dummy, host, path = url.split("/", 3)
     except ValueError:
@@ -63,42 +449,70 @@ async def request(
         host, str_port = host.split(":", 1)
         port = int(str_port)
 
-    reader, writer = await asyncio.open_connection(host, port)
-    await writer.awrite(b"%s /%s HTTP/1.0\r\n" % (method.encode(), path.encode()))
-    if "Host" not in headers:
-        await writer.awrite(b"Host: %s\r\n" % host.encode())
-    # Iterate over keys to avoid tuple alloc
-    for k in headers:
-        await writer.awrite(k)
-        await writer.awrite(b": ")
-        await writer.awrite(headers[k])
-        await writer.awrite(b"\r\n")
     if json is not None:
         assert data is None
         import ujson
         data = ujson.dumps(json).encode('UTF8')
-    if data:
-        await writer.awrite(b"Content-Length: %d\r\n" % len(data))
-    await writer.awrite(b"\r\n")
-    if data:
-        await writer.awrite(data)
 
-    line = await reader.readline()
-    protover, status, msg = line.split(None, 2)
-    status = int(status)
-    # print(protover, status, msg)
-    while True:
-        line = await reader.readline()
-        if not line or line == b"\r\n":
-            break
-        # print(line)
-        if line.startswith(b"Transfer-Encoding:"):
-            if b"chunked" in line:
-                raise ValueError("Unsupported " + line)
-        elif line.startswith(b"Location:") and not 200 <= status <= 299:
-            raise NotImplementedError("Redirects not yet supported")
-
-    resp = Response(reader, status, msg.rstrip())
+    conn, reused = await pool.acquire(host, port)
+    try:
+        await _send(conn, method, host, path, data, headers)
+        line = await conn.reader.readline()
+    except OSError:
+        if not reused:
+            await pool.release(conn, False)
+            raise
+        line = b""
+    if not line and reused:
+        # The server closed the idle connection, most likely before we
+        # used it. Only requests that are safe to repeat are sent again on
+        # a new one, in case the server did act on it.
+        await pool.discard(conn)
+        if method not in IDEMPOTENT:
+            raise OSError("Connection closed by server")
+        conn = await pool.connect(host, port)
+        try:
+            await _send(conn, method, host, path, data, headers)
+            line = await conn.reader.readline()
+        except OSError:
+            await pool.release(conn, False)
+            raise
+    conn.requests += 1
+    reader = conn.reader
+
+    try:
+        protover, status, msg = line.split(None, 2)
+        status = int(status)
+        # print(protover, status, msg)
+        keep_alive = protover == b"HTTP/1.1"
+        length = None  # type: Optional[int]
+        chunked = False
+        while True:
+            line = await reader.readline()
+            if not line or line == b"\r\n":
+                break
+            # print(line)
+            name, value = line.split(b":", 1)
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == b"content-length":
+                length = int(value)
+            elif name == b"transfer-encoding":
+                chunked = b"chunked" in value
+            elif name == b"connection":
+                keep_alive = value == b"keep-alive"
+            elif name == b"location" and not 200 <= status <= 299:
+                raise NotImplementedError("Redirects not yet supported")
+    except Exception:
+        await pool.release(conn, False)
+        raise
+
+    if method == "HEAD" or status in (204, 304):
+        length = 0
+        chunked = False
+    resp = Response(reader, status, msg.rstrip(), length, chunked, conn, pool, keep_alive)
+    if length == 0:
+        await resp._finish(True)
     return resp
 
 
@@ -1,13 +1,18 @@
 import abc
+import formats
+import utime
 
 from subscriptions import Subscriptions
 
 try:
     from typing import Any, Awaitable, Callable, List, Optional, Tuple
-    Callback = Callable[['Config', list[str], str, Any], Awaitable[None]]
+    Callback = Callable[['Config', bytes, str, Any], Awaitable[None]]
 except ImportError:
     pass
 
+# How long to show a predicted state before giving up on the device.
+PREDICTION_TIMEOUT_MS = 3000
+
 
 class Config:
     name: str
@@ -17,6 +22,7 @@ class Config:
     type: str
     action: str
     params: dict[str, Any]
+    format: str
 
     def __init__(
             self, name: str, id: str, location: str, device: str, type: str, action: str, params: dict[str, Any]
@@ -28,33 +34,97 @@ class Config:
         self.type = type
         self.action = action
         self.params = params
+        # Payload format of the device's commands and list states.
+        self.format = params.get("format", "json")
 
 
+# A command for a device, serialised when it is created so sending it does
+# no work. Buttons build every command they can send when configured.
+# state_prefixes are the state topics of the devices that act on it, which
+# for a group command are the devices in the group. Queued commands with the
+# same key replace each other: a light command's key includes its scene, as
+# commands for different scenes all take effect.
 class Command():
     location: str
     device: str
     message: dict[str, Any]
+    topic: bytes
+    payload: bytes
+    key: bytes
+    state_prefixes: List[bytes]
 
-
+    def __init__(
+            self, location: str, device: str, message: dict[str, Any], format: str = "json",
+            devices: Optional[List[Tuple[str, str]]] = None) -> None:
+        self.location = location
+        self.device = device
+        self.message = message
+        self.topic = "command/{}/{}".format(location, device).encode('UTF8')
+        self.payload = formats.encode(message, format)
+        scene = message.get("scene")
+        self.key = self.topic if scene is None else self.topic + b"/" + scene.encode('UTF8')
+        if devices is None:
+            devices = [(location, device)]
+        self.state_prefixes = [
+            "state/{}/{}/".format(location, device).encode('UTF8') for location, device in devices]
+
+
+# Besides the state reported by the device, a button can hold a predicted
+# state, worked out from the commands it has just sent. Commands that are
+# not expected to change the display state are not predicted. Otherwise the
+# prediction is shown until the display state reaches it, which confirms it.
+# It is only rolled back once every state topic of the button has reported
+# since the command was sent: a device publishes its topics one at a time,
+# and the first may repeat the old state or give a mix of old and new. If
+# the state is not settled in time the button shows state_unknown until the
+# next state message.
 class Button():
     config: Config
+    _predicted: Optional[str] = None
+    _predicted_at: int = 0
+    _expired: bool = False
+    _reported: List[str] = []
+    _num_topics: int = 0
+    _display_state: Optional[str] = None
 
     @abc.abstractmethod
     def __init__(self, config: Config) -> None:
         raise NotImplementedError()
 
+    def set_config(self, config: Config) -> None:
+        self.config = config
+        self._display_state = None
+        self._num_topics = len(self.get_topics())
+        self._build_commands()
+
+    def _build_commands(self) -> None:
+        pass
+
     @abc.abstractmethod
     def get_topics(self) -> List[Tuple[List[str], str, str]]:
         raise NotImplementedError()
 
+    # Returns True if the message changed the button's state.
+    def process_nessage(self, label: str, data: Any) -> bool:
+        changed = self._process_nessage(label, data)
+        if changed:
+            self._display_state = None
+        return changed
+
     @abc.abstractmethod
-    def process_nessage(self, label: str, data: Any) -> None:
+    def _process_nessage(self, label: str, data: Any) -> bool:
         raise NotImplementedError()
 
     @abc.abstractmethod
-    def get_display_state(self) -> str:
+    def _compute_display_state(self) -> str:
         raise NotImplementedError()
 
+    def get_display_state(self) -> str:
+        # Cached until process_nessage() changes something.
+        if self._display_state is None:
+            self._display_state = self._compute_display_state()
+        return self._display_state
+
     @abc.abstractmethod
     def get_press_commands(self) -> List[Command]:
         raise NotImplementedError()
@@ -65,6 +135,95 @@ class Button():
     def get_double_commands(self) -> List[Command]:
         return []
 
+    def has_long_commands(self) -> bool:
+        return False
+
+    def has_double_commands(self) -> bool:
+        return False
+
+    def _predict_display_state(self, message: dict[str, Any]) -> Optional[str]:
+        return None
+
+    def predict_state(self, commands: List[Command]) -> Optional[str]:
+        # The display state commands should lead to, if it can be worked out.
+        config = self.config
+        predicted = None
+        for command in commands:
+            if command.location == config.location and command.device == config.device:
+                state = self._predict_display_state(command.message)
+                if state is not None:
+                    predicted = state
+        return predicted
+
+    def _get_inverse_commands(self, commands: List[Command]) -> List[Command]:
+        return []
+
+    def get_undo_commands(self, commands: List[Command]) -> List[Command]:
+        # Commands that undo sending commands from the state now shown, or
+        # none if they should not change it.
+        predicted = self.predict_state(commands)
+        if predicted is None or predicted == self.get_shown_state():
+            return []
+        return self._get_inverse_commands(commands)
+
+    def predict(self, commands: List[Command]) -> bool:
+        # Returns True if what the button shows has changed.
+        predicted = self.predict_state(commands)
+        if predicted is None:
+            return False
+        shown = self.get_shown_state()
+        pending = self.is_pending()
+        if predicted == self.get_display_state():
+            # The device may well not report back, as nothing changes.
+            self._predicted = None
+        else:
+            self._predicted = predicted
+            self._predicted_at = utime.ticks_ms()
+            self._reported = []
+        self._expired = False
+        return shown != self.get_shown_state() or pending != self.is_pending()
+
+    def is_pending(self) -> bool:
+        return self._predicted is not None
+
+    def expire_prediction(self) -> bool:
+        # Returns True if the prediction has just timed out.
+        if self._predicted is None:
+            return False
+        if utime.ticks_diff(utime.ticks_ms(), self._predicted_at) < PREDICTION_TIMEOUT_MS:
+            return False
+        self._predicted = None
+        self._expired = True
+        return True
+
+    def receive(self, label: str, data: Any) -> bool:
+        # Returns True if what the button shows has changed.
+        shown = self.get_shown_state()
+        pending = self.is_pending()
+        changed = self.process_nessage(label, data)
+        if not changed and not self._expired and self._predicted is None:
+            return False
+        state = self.get_display_state()
+        if self._expired:
+            self._expired = False
+        elif self._predicted is not None:
+            if label not in self._reported:
+                self._reported.append(label)
+            if state == self._predicted:
+                self._predicted = None
+            elif len(self._reported) >= self._num_topics:
+                print("{}: prediction {} rolled back to {}".format(self.config.name, self._predicted, state))
+                self._predicted = None
+        return shown != self.get_shown_state() or pending != self.is_pending()
+
+    def get_shown_state(self) -> str:
+        if self._predicted is not None:
+            return self._predicted
+        elif self._expired:
+            return "state_unknown"
+        else:
+            return self.get_display_state()
+
 
 def _has_priority(priorities: Optional[List[int]], priority: int) -> Optional[bool]:
     if priorities is None:
@@ -78,11 +237,14 @@ class LightButton(Button):
     scenes: Optional[List[str]]
     priorities: Optional[List[int]]
 
+    _on_commands: dict[str, List[Command]]
+    _off_commands: dict[str, List[Command]]
+
     def __init__(self, config: Config) -> None:
         self.power = None
         self.scenes = None
         self.priorities = None
-        self.config = config
+        self.set_config(config)
 
     def get_topics(self) -> List[Tuple[List[str], str, str]]:
         config = self.config
@@ -94,25 +256,29 @@ class LightButton(Button):
             ),
             (
                 ["state", config.location, config.device, "scenes"],
-                "json", "scenes"
+                config.format, "scenes"
             ),
             (
                 ["state", config.location, config.device, "priorities"],
-                "json", "priorities"
+                config.format, "priorities"
             )
         ]
 
-    def process_nessage(self, label: str, data: Any) -> None:
+    def _process_nessage(self, label: str, data: Any) -> bool:
         if label == "power":
+            changed = self.power != data
             self.power = data
         elif label == "scenes":
+            changed = self.scenes != data
             self.scenes = data
         elif label == "priorities":
+            changed = self.priorities != data
             self.priorities = data
         else:
             raise RuntimeError("Unknown label {}".format(label))
+        return bool(changed)
 
-    def get_display_state(self) -> str:
+    def _compute_display_state(self) -> str:
         config = self.config
         correct_priority = _has_priority(self.priorities, config.params["priority"])
 
@@ -164,29 +330,39 @@ class LightButton(Button):
         else:
             raise RuntimeError()
 
+    def _build_commands(self) -> None:
+        config = self.config
+        self._on_commands = {}
+        self._off_commands = {}
+
+        for scene in (config.params["scene"], "dim", "rainbow"):
+            message = {
+                "scene": scene,
+                "priority": config.params["priority"]
+            }
+            self._on_commands[scene] = [Command(config.location, config.device, message, config.format)]
+
+            message = dict(message)
+            message["action"] = "turn_off"
+            self._off_commands[scene] = [Command(config.location, config.device, message, config.format)]
+
     def _get_commands(self, scene: str, desired_state: str) -> List[Command]:
         config = self.config
-        message = {
-            "scene": scene,
-            "priority": config.params["priority"]
-        }
 
         if config.action == "turn_on":
-            pass
+            turn_off = False
         elif config.action == "turn_off":
-            message["action"] = "turn_off"
+            turn_off = True
         elif config.action == "toggle":
-            display_state = self.get_display_state()
-            if display_state == desired_state:
-                message["action"] = "turn_off"
+            display_state = self.get_shown_state()
+            turn_off = display_state == desired_state
         else:
             raise RuntimeError()
 
-        command = Command()
-        command.location = config.location
-        command.device = config.device
-        command.message = message
-        return [command]
+        if turn_off:
+            return self._off_commands[scene]
+        else:
+            return self._on_commands[scene]
 
     def get_press_commands(self) -> List[Command]:
         return self._get_commands(self.config.params["scene"], "state_on")
@@ -197,13 +373,47 @@ class LightButton(Button):
     def get_double_commands(self) -> List[Command]:
         return self._get_commands("rainbow", "state_rainbow")
 
+    def has_long_commands(self) -> bool:
+        return True
+
+    def has_double_commands(self) -> bool:
+        return True
+
+    def _get_inverse_commands(self, commands: List[Command]) -> List[Command]:
+        for scene, on_commands in self._on_commands.items():
+            if commands is on_commands:
+                return self._off_commands[scene]
+            if commands is self._off_commands[scene]:
+                return on_commands
+        return []
+
+    def _predict_display_state(self, message: dict[str, Any]) -> Optional[str]:
+        if message.get("action") == "turn_off":
+            if self.config.action == "turn_off":
+                return "state_on"
+            return "state_off"
+        elif message["scene"] == "dim":
+            return "state_dim"
+        elif message["scene"] == "rainbow":
+            return "state_rainbow"
+        else:
+            return "state_on"
+
 
 class SwitchButton(Button):
     power: Optional[str]
 
+    _turn_on: List[Command]
+    _turn_off: List[Command]
+
     def __init__(self, config: Config) -> None:
         self.power = None
-        self.config = config
+        self.set_config(config)
+
+    def _build_commands(self) -> None:
+        config = self.config
+        self._turn_on = [Command(config.location, config.device, {"action": "turn_on"}, config.format)]
+        self._turn_off = [Command(config.location, config.device, {"action": "turn_off"}, config.format)]
 
     def get_topics(self) -> List[Tuple[List[str], str, str]]:
         config = self.config
@@ -215,67 +425,171 @@ class SwitchButton(Button):
             ),
         ]
 
-    def process_nessage(self, label: str, data: Any) -> None:
+    def _process_nessage(self, label: str, data: Any) -> bool:
         if label == "power":
-            self.power = data or None
+            power = data or None
+            changed = self.power != power
+            self.power = power
         else:
             raise RuntimeError("Unknown label {}".format(label))
+        return changed
 
-    def get_display_state(self) -> str:
+    def _get_display_state(self, power: Optional[str]) -> str:
         config = self.config
 
-        if self.power == "HARD_OFF":
+        if power == "HARD_OFF":
             return "state_hard_off"
-        elif self.power == "HARD_OFF":
+        elif power == "HARD_OFF":
             return "state_error"
-        elif self.power is None:
+        elif power is None:
             return "state_unknown"
         elif config.action == "turn_on":
-            if self.power == "ON":
+            if power == "ON":
                 return "state_on"
-            elif self.power == "OFF":
+            elif power == "OFF":
                 return "state_off"
             else:
                 raise RuntimeError()
         elif config.action == "turn_off":
-            if self.power == "ON":
+            if power == "ON":
                 return "state_off"
-            elif self.power == "OFF":
+            elif power == "OFF":
                 return "state_on"
             else:
                 raise RuntimeError()
         elif config.action == "toggle":
-            if self.power == "ON":
+            if power == "ON":
                 return "state_on"
-            elif self.power == "OFF":
+            elif power == "OFF":
                 return "state_off"
             else:
                 raise RuntimeError()
         else:
             raise RuntimeError()
 
+    def _compute_display_state(self) -> str:
+        return self._get_display_state(self.power)
+
+    def _get_inverse_commands(self, commands: List[Command]) -> List[Command]:
+        if commands is self._turn_on:
+            return self._turn_off
+        if commands is self._turn_off:
+            return self._turn_on
+        return []
+
+    def _predict_display_state(self, message: dict[str, Any]) -> Optional[str]:
+        if message.get("action") == "turn_on":
+            return self._get_display_state("ON")
+        elif message.get("action") == "turn_off":
+            return self._get_display_state("OFF")
+        else:
+            return None
+
     def get_press_commands(self) -> List[Command]:
         config = self.config
-        message = {}
 
         if config.action == "turn_on":
-            message["action"] = "turn_on"
+            return self._turn_on
         elif config.action == "turn_off":
-            message["action"] = "turn_off"
+            return self._turn_off
         elif config.action == "toggle":
-            display_state = self.get_display_state()
+            display_state = self.get_shown_state()
             if display_state == "state_on":
-                message["action"] = "turn_off"
+                return self._turn_off
             else:
-                message["action"] = "turn_on"
+                return self._turn_on
         else:
             raise RuntimeError()
 
-        command = Command()
-        command.location = config.location
-        command.device = config.device
-        command.message = message
-        return [command]
+
+# Sets a scene on several devices at once, given as [location, device] pairs
+# in params["devices"]. If params["group"] is set, the broker expands
+# command/group/<group> to the devices, so only one command is sent.
+class GroupButton(Button):
+    scenes: List[Optional[List[str]]]
+    _on_commands: List[Command]
+    _off_commands: List[Command]
+
+    def __init__(self, config: Config) -> None:
+        self.scenes = [None] * len(config.params["devices"])
+        self.set_config(config)
+
+    def _build_commands(self) -> None:
+        config = self.config
+        on_message = {
+            "scene": config.params["scene"],
+            "priority": config.params["priority"]
+        }
+        off_message = dict(on_message)
+        off_message["action"] = "turn_off"
+
+        if "group" in config.params:
+            devices = [(location, device) for location, device in config.params["devices"]]
+            self._on_commands = [Command("group", config.params["group"], on_message, config.format, devices)]
+            self._off_commands = [Command("group", config.params["group"], off_message, config.format, devices)]
+        else:
+            self._on_commands = [
+                Command(location, device, on_message, config.format)
+                for location, device in config.params["devices"]]
+            self._off_commands = [
+                Command(location, device, off_message, config.format)
+                for location, device in config.params["devices"]]
+
+    def get_topics(self) -> List[Tuple[List[str], str, str]]:
+        return [
+            (["state", location, device, "scenes"], self.config.format, str(i))
+            for i, (location, device) in enumerate(self.config.params["devices"])
+        ]
+
+    def _process_nessage(self, label: str, data: Any) -> bool:
+        i = int(label)
+        changed = self.scenes[i] != data
+        self.scenes[i] = data
+        return bool(changed)
+
+    def _compute_display_state(self) -> str:
+        scene = self.config.params["scene"]
+        for scenes in self.scenes:
+            if scenes is None:
+                return "state_unknown"
+        for scenes in self.scenes:
+            if scenes is not None and scene not in scenes:
+                return "state_off"
+        return "state_on"
+
+    def predict_state(self, commands: List[Command]) -> Optional[str]:
+        # Commands may go to the group rather than the devices.
+        if len(commands) > 0:
+            return self._predict_display_state(commands[0].message)
+        return None
+
+    def _get_inverse_commands(self, commands: List[Command]) -> List[Command]:
+        if commands is self._on_commands:
+            return self._off_commands
+        if commands is self._off_commands:
+            return self._on_commands
+        return []
+
+    def _predict_display_state(self, message: dict[str, Any]) -> Optional[str]:
+        if message.get("action") == "turn_off":
+            return "state_off"
+        else:
+            return "state_on"
+
+    def get_press_commands(self) -> List[Command]:
+        config = self.config
+
+        if config.action == "turn_on":
+            return self._on_commands
+        elif config.action == "turn_off":
+            return self._off_commands
+        elif config.action == "toggle":
+            if self.get_shown_state() == "state_on":
+                return self._off_commands
+            else:
+                return self._on_commands
+        else:
+            raise RuntimeError()
 
 
 def get_button_controller(config: Config) -> Button:
@@ -283,6 +597,8 @@ def get_button_controller(config: Config) -> Button:
         return LightButton(config)
     elif config.type == "switch":
         return SwitchButton(config)
+    elif config.type == "group":
+        return GroupButton(config)
 
     raise RuntimeError("Uknown button type {}".format(config.type))
 
@@ -290,7 +606,7 @@ def get_button_controller(config: Config) -> Button:
 async def subscribe_topics(button: Button, subscriptions: Subscriptions, callback: Callback) -> None:
     topics = button.get_topics()
 
-    async def internal_callback(topic: list[str], label: str, data: Any) -> None:
+    async def internal_callback(topic: bytes, label: str, data: Any) -> None:
         await callback(button.config, topic, label, data)
 
     for topic, format, label in topics:
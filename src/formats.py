@@ -0,0 +1,423 @@
+import json
+import struct
+
+try:
+    from typing import Any, Callable
+    Decoder = Callable[[bytes], Any]
+    Encoder = Callable[[Any], bytes]
+except ImportError:
+    pass
+
+
+# Payload formats, by the name given as the format of a subscription or a
+# publish. "json" and "raw" (UTF-8 text) are what the rest of the house
+# speaks; "cbor" and "msgpack" are compact binary encodings that are much
+# cheaper to parse here. Only the types JSON can express are supported:
+# None, bool, int, float, str, bytes, list and dict.
+_decoders: dict[str, Decoder] = {}
+_encoders: dict[str, Encoder] = {}
+
+
+def register(format: str, decoder: Decoder, encoder: Encoder) -> None:
+    _decoders[format] = decoder
+    _encoders[format] = encoder
+
+
+def decode(payload: bytes, format: str) -> Any:
+    decoder = _decoders.get(format)
+    if decoder is None:
+        raise RuntimeError("Unknown message format %s" % format)
+    return decoder(payload)
+
+
+def encode(data: Any, format: str) -> bytes:
+    encoder = _encoders.get(format)
+    if encoder is None:
+        raise RuntimeError("Unknown message format %s" % format)
+    return encoder(data)
+
+
+def _json_loads(payload: bytes) -> Any:
+    return json.loads(payload.decode('UTF8'))
+
+
+def _json_dumps(data: Any) -> bytes:
+    return json.dumps(data).encode('UTF8')
+
+
+def _raw_loads(payload: bytes) -> Any:
+    return payload.decode('UTF8')
+
+
+def _raw_dumps(data: Any) -> bytes:
+    return str(data).encode('UTF8')
+
+
+# Both binary decoders walk the payload with an offset instead of slicing
+# it, so only the decoded values themselves are allocated. Malformed or
+# truncated payloads raise ValueError, like json.loads.
+class _Reader:
+    def __init__(self, payload: bytes) -> None:
+        self.buf = memoryview(payload)
+        self.pos = 0
+
+    def byte(self) -> int:
+        pos = self.pos
+        if pos >= len(self.buf):
+            raise ValueError("truncated payload")
+        self.pos = pos + 1
+        return self.buf[pos]
+
+    def unpack(self, fmt: str, size: int) -> Any:
+        pos = self.pos
+        if pos + size > len(self.buf):
+            raise ValueError("truncated payload")
+        self.pos = pos + size
+        return struct.unpack_from(fmt, self.buf, pos)[0]
+
+    def take(self, size: int) -> bytes:
+        pos = self.pos
+        if pos + size > len(self.buf):
+            raise ValueError("truncated payload")
+        self.pos = pos + size
+        return bytes(self.buf[pos:pos + size])
+
+    def end(self) -> None:
+        if self.pos != len(self.buf):
+            raise ValueError("trailing data in payload")
+
+
+# CBOR (RFC 8949).
+
+_CBOR_BREAK = object()
+
+
+def _cbor_half(bits: int) -> float:
+    exponent = (bits >> 10) & 0x1f
+    mantissa = bits & 0x3ff
+    if exponent == 0:
+        value = mantissa * 2.0 ** -24
+    elif exponent == 0x1f:
+        value = float("inf") if mantissa == 0 else float("nan")
+    else:
+        value = (mantissa + 1024) * 2.0 ** (exponent - 25)
+    return -value if bits & 0x8000 else value
+
+
+def _cbor_length(reader: _Reader, info: int) -> int:
+    if info < 24:
+        return info
+    if info == 24:
+        return reader.byte()
+    if info == 25:
+        return int(reader.unpack(">H", 2))
+    if info == 26:
+        return int(reader.unpack(">I", 4))
+    if info == 27:
+        return int(reader.unpack(">Q", 8))
+    raise ValueError("bad CBOR length %d" % info)
+
+
+def _map_set(result: dict[Any, Any], key: Any, value: Any) -> None:
+    try:
+        result[key] = value
+    except TypeError:
+        raise ValueError("unhashable map key")
+
+
+# A break is only returned where allow_break is set, which is for the next
+# item of an indefinite length array or map; anywhere else it is an error.
+def _cbor_item(reader: _Reader, allow_break: bool = False) -> Any:
+    initial = reader.byte()
+    major = initial >> 5
+    info = initial & 0x1f
+
+    if major == 7:
+        if info == 20:
+            return False
+        if info == 21:
+            return True
+        if info == 22 or info == 23:
+            return None
+        if info == 25:
+            return _cbor_half(reader.unpack(">H", 2))
+        if info == 26:
+            return reader.unpack(">f", 4)
+        if info == 27:
+            return reader.unpack(">d", 8)
+        if info == 31:
+            if allow_break:
+                return _CBOR_BREAK
+            raise ValueError("unexpected CBOR break")
+        raise ValueError("unsupported CBOR simple value %d" % info)
+
+    if info == 31:
+        # Indefinite length; only arrays and maps are supported.
+        if major == 4:
+            items: list[Any] = []
+            while True:
+                item = _cbor_item(reader, True)
+                if item is _CBOR_BREAK:
+                    return items
+                items.append(item)
+        if major == 5:
+            result: dict[Any, Any] = {}
+            while True:
+                key = _cbor_item(reader, True)
+                if key is _CBOR_BREAK:
+                    return result
+                _map_set(result, key, _cbor_item(reader))
+        raise ValueError("unsupported indefinite CBOR item %d" % major)
+
+    length = _cbor_length(reader, info)
+    if major == 0:
+        return length
+    if major == 1:
+        return -1 - length
+    if major == 2:
+        return reader.take(length)
+    if major == 3:
+        return reader.take(length).decode('UTF8')
+    if major == 4:
+        return [_cbor_item(reader) for _ in range(length)]
+    if major == 5:
+        result = {}
+        for _ in range(length):
+            key = _cbor_item(reader)
+            _map_set(result, key, _cbor_item(reader))
+        return result
+    # major == 6: a tag; the tagged item is returned as is.
+    return _cbor_item(reader)
+
+
+def cbor_loads(payload: bytes) -> Any:
+    reader = _Reader(payload)
+    result = _cbor_item(reader)
+    reader.end()
+    return result
+
+
+def _cbor_head(out: bytearray, major: int, length: int) -> None:
+    major <<= 5
+    if length < 24:
+        out.append(major | length)
+    elif length < 0x100:
+        out.append(major | 24)
+        out.append(length)
+    elif length < 0x10000:
+        out.append(major | 25)
+        out.extend(struct.pack(">H", length))
+    elif length < 0x100000000:
+        out.append(major | 26)
+        out.extend(struct.pack(">I", length))
+    else:
+        out.append(major | 27)
+        out.extend(struct.pack(">Q", length))
+
+
+def _cbor_write(out: bytearray, data: Any) -> None:
+    if data is None:
+        out.append(0xf6)
+    elif data is True:
+        out.append(0xf5)
+    elif data is False:
+        out.append(0xf4)
+    elif isinstance(data, int):
+        if data >= 0:
+            _cbor_head(out, 0, data)
+        else:
+            _cbor_head(out, 1, -1 - data)
+    elif isinstance(data, float):
+        out.append(0xfb)
+        out.extend(struct.pack(">d", data))
+    elif isinstance(data, str):
+        encoded = data.encode('UTF8')
+        _cbor_head(out, 3, len(encoded))
+        out.extend(encoded)
+    elif isinstance(data, (bytes, bytearray)):
+        _cbor_head(out, 2, len(data))
+        out.extend(data)
+    elif isinstance(data, (list, tuple)):
+        _cbor_head(out, 4, len(data))
+        for item in data:
+            _cbor_write(out, item)
+    elif isinstance(data, dict):
+        _cbor_head(out, 5, len(data))
+        for key, value in data.items():
+            _cbor_write(out, key)
+            _cbor_write(out, value)
+    else:
+        raise TypeError("can't encode %s as CBOR" % type(data))
+
+
+def cbor_dumps(data: Any) -> bytes:
+    out = bytearray()
+    _cbor_write(out, data)
+    return bytes(out)
+
+
+# MessagePack.
+
+def _msgpack_item(reader: _Reader) -> Any:
+    initial = reader.byte()
+
+    if initial <= 0x7f:
+        return initial
+    if initial >= 0xe0:
+        return initial - 0x100
+    if initial <= 0x8f:
+        return _msgpack_map(reader, initial & 0x0f)
+    if initial <= 0x9f:
+        return [_msgpack_item(reader) for _ in range(initial & 0x0f)]
+    if initial <= 0xbf:
+        return reader.take(initial & 0x1f).decode('UTF8')
+
+    if initial == 0xc0:
+        return None
+    if initial == 0xc2:
+        return False
+    if initial == 0xc3:
+        return True
+    if initial == 0xc4:
+        return reader.take(reader.byte())
+    if initial == 0xc5:
+        return reader.take(reader.unpack(">H", 2))
+    if initial == 0xc6:
+        return reader.take(reader.unpack(">I", 4))
+    if initial == 0xca:
+        return reader.unpack(">f", 4)
+    if initial == 0xcb:
+        return reader.unpack(">d", 8)
+    if initial == 0xcc:
+        return reader.byte()
+    if initial == 0xcd:
+        return reader.unpack(">H", 2)
+    if initial == 0xce:
+        return reader.unpack(">I", 4)
+    if initial == 0xcf:
+        return reader.unpack(">Q", 8)
+    if initial == 0xd0:
+        return reader.unpack(">b", 1)
+    if initial == 0xd1:
+        return reader.unpack(">h", 2)
+    if initial == 0xd2:
+        return reader.unpack(">i", 4)
+    if initial == 0xd3:
+        return reader.unpack(">q", 8)
+    if initial == 0xd9:
+        return reader.take(reader.byte()).decode('UTF8')
+    if initial == 0xda:
+        return reader.take(reader.unpack(">H", 2)).decode('UTF8')
+    if initial == 0xdb:
+        return reader.take(reader.unpack(">I", 4)).decode('UTF8')
+    if initial == 0xdc:
+        return [_msgpack_item(reader) for _ in range(reader.unpack(">H", 2))]
+    if initial == 0xdd:
+        return [_msgpack_item(reader) for _ in range(reader.unpack(">I", 4))]
+    if initial == 0xde:
+        return _msgpack_map(reader, reader.unpack(">H", 2))
+    if initial == 0xdf:
+        return _msgpack_map(reader, reader.unpack(">I", 4))
+    raise ValueError("unsupported msgpack type 0x%02x" % initial)
+
+
+def _msgpack_map(reader: _Reader, length: int) -> dict[Any, Any]:
+    result: dict[Any, Any] = {}
+    for _ in range(length):
+        key = _msgpack_item(reader)
+        _map_set(result, key, _msgpack_item(reader))
+    return result
+
+
+def msgpack_loads(payload: bytes) -> Any:
+    reader = _Reader(payload)
+    result = _msgpack_item(reader)
+    reader.end()
+    return result
+
+
+def _msgpack_head(out: bytearray, fix: int, fix_max: int, codes: bytes, length: int) -> None:
+    # codes are the 8, 16 and 32 bit forms; 0 where there is none.
+    if length <= fix_max:
+        out.append(fix | length)
+    elif length < 0x100 and codes[0]:
+        out.append(codes[0])
+        out.append(length)
+    elif length < 0x10000:
+        out.append(codes[1])
+        out.extend(struct.pack(">H", length))
+    else:
+        out.append(codes[2])
+        out.extend(struct.pack(">I", length))
+
+
+def _msgpack_write(out: bytearray, data: Any) -> None:
+    if data is None:
+        out.append(0xc0)
+    elif data is True:
+        out.append(0xc3)
+    elif data is False:
+        out.append(0xc2)
+    elif isinstance(data, int):
+        if 0 <= data <= 0x7f:
+            out.append(data)
+        elif -32 <= data < 0:
+            out.append(data + 0x100)
+        elif data >= 0:
+            if data < 0x100:
+                out.append(0xcc)
+                out.append(data)
+            elif data < 0x10000:
+                out.append(0xcd)
+                out.extend(struct.pack(">H", data))
+            elif data < 0x100000000:
+                out.append(0xce)
+                out.extend(struct.pack(">I", data))
+            else:
+                out.append(0xcf)
+                out.extend(struct.pack(">Q", data))
+        elif data >= -0x80:
+            out.append(0xd0)
+            out.extend(struct.pack(">b", data))
+        elif data >= -0x8000:
+            out.append(0xd1)
+            out.extend(struct.pack(">h", data))
+        elif data >= -0x80000000:
+            out.append(0xd2)
+            out.extend(struct.pack(">i", data))
+        else:
+            out.append(0xd3)
+            out.extend(struct.pack(">q", data))
+    elif isinstance(data, float):
+        out.append(0xcb)
+        out.extend(struct.pack(">d", data))
+    elif isinstance(data, str):
+        encoded = data.encode('UTF8')
+        _msgpack_head(out, 0xa0, 0x1f, b"\xd9\xda\xdb", len(encoded))
+        out.extend(encoded)
+    elif isinstance(data, (bytes, bytearray)):
+        _msgpack_head(out, 0xc4, -1, b"\xc4\xc5\xc6", len(data))
+        out.extend(data)
+    elif isinstance(data, (list, tuple)):
+        _msgpack_head(out, 0x90, 0x0f, b"\x00\xdc\xdd", len(data))
+        for item in data:
+            _msgpack_write(out, item)
+    elif isinstance(data, dict):
+        _msgpack_head(out, 0x80, 0x0f, b"\x00\xde\xdf", len(data))
+        for key, value in data.items():
+            _msgpack_write(out, key)
+            _msgpack_write(out, value)
+    else:
+        raise TypeError("can't encode %s as msgpack" % type(data))
+
+
+def msgpack_dumps(data: Any) -> bytes:
+    out = bytearray()
+    _msgpack_write(out, data)
+    return bytes(out)
+
+
+register("json", _json_loads, _json_dumps)
+register("raw", _raw_loads, _raw_dumps)
+register("cbor", cbor_loads, cbor_dumps)
+register("msgpack", msgpack_loads, msgpack_dumps)
@@ -0,0 +1,244 @@
+import uasyncio as asyncio
+import array
+import asyn
+import machine
+import utime
+
+from tracing import tracer
+
+try:
+    from typing import Any, Callable, Dict, List, Optional
+    Callback = Callable[[], Any]
+except ImportError:
+    pass
+
+
+# If a callback is passed, run it and return.
+# If a coro is passed initiate it and return.
+# coros are passed by name i.e. not using function call syntax.
+def launch(func: Optional[Callback]) -> None:
+    if func is not None:
+        tracer.mark("launch")
+        res = func()
+        if isinstance(res, asyn.type_coro):
+            loop = asyncio.get_event_loop()
+            loop.create_task(res)
+
+
+# Edges captured by the pin interrupt handlers, as (button id, level,
+# ticks_us) entries. All storage is allocated up front, so push() can be
+# called from an interrupt. When the ring is full new edges are counted as
+# overflows and discarded.
+class EventRing:
+    def __init__(self, size: int) -> None:
+        self._size = size
+        self._ids = bytearray(size)
+        self._levels = bytearray(size)
+        self._ticks = array.array('i', [0] * size)
+        self._head = 0
+        self._tail = 0
+        self.overflows = 0
+
+    def push(self, id: int, level: int, ticks: int) -> None:
+        head = self._head
+        next_head = head + 1
+        if next_head >= self._size:
+            next_head = 0
+        if next_head == self._tail:
+            self.overflows += 1
+            return
+        self._ids[head] = id
+        self._levels[head] = level
+        self._ticks[head] = ticks
+        self._head = next_head
+
+    def is_empty(self) -> bool:
+        return self._head == self._tail
+
+    def pop(self) -> tuple[int, int, int]:
+        tail = self._tail
+        result = (self._ids[tail], self._levels[tail], self._ticks[tail])
+        tail += 1
+        if tail >= self._size:
+            tail = 0
+        self._tail = tail
+        return result
+
+
+# A push button. A press is reported when released if no double click is
+# bound; otherwise it has to wait out the double click window. With
+# speculative set, a press is reported as soon as it is released anyway. If
+# it turns out to be a double click, the correct function is run instead of
+# the double click function; it should undo the press and then do the double
+# click action.
+class Button:
+    debounce_ms = 20
+    double_click_ms = 500
+    speculative = False
+
+    def __init__(self, pin: machine.Pin, scanner: 'ButtonScanner') -> None:
+        self.pin = pin  # Initialise for input
+        self._press_func = None  # type: Optional[Callback]
+        self._release_func = None  # type: Optional[Callback]
+        self._double_func = None  # type: Optional[Callback]
+        self._long_func = None  # type: Optional[Callback]
+        self._correct_func = None  # type: Optional[Callback]
+        self.sense = pin.value()  # Convert from electrical to logical value
+        self.buttonstate = self.rawstate()  # Initial state
+
+        # Debounce: time of the first and latest edge while bouncing, and
+        # the level read at the latest edge.
+        self._bouncing = False
+        self._edge_start = 0
+        self._last_edge = 0
+        self._level = pin.value()
+
+        # Gesture window, opened by the first press.
+        self._window = False
+        self._deadline = 0
+        self._num_presses = 0
+        self._num_releases = 0
+        self._speculated = False
+
+        self._ring = scanner.ring
+        self._wake = scanner.wake
+        self._id = scanner.add(self)
+        pin.irq(
+            trigger=machine.Pin.IRQ_RISING | machine.Pin.IRQ_FALLING,
+            handler=self._irq)
+
+    def press_func(self, func: Callback) -> None:
+        self._press_func = func
+
+    def release_func(self, func: Callback) -> None:
+        self._release_func = func
+
+    def double_func(self, func: Callback) -> None:
+        self._double_func = func
+
+    def long_func(self, func: Callback) -> None:
+        self._long_func = func
+
+    def correct_func(self, func: Callback) -> None:
+        self._correct_func = func
+
+    # Current non-debounced logical button state: True == pressed
+    def rawstate(self) -> bool:
+        return bool(self.pin.value() ^ self.sense)
+
+    # Current debounced state of button (True == pressed)
+    def __call__(self) -> bool:
+        return self.buttonstate
+
+    def _irq(self, pin: machine.Pin) -> None:
+        # Must not allocate.
+        self._ring.push(self._id, pin.value(), utime.ticks_us())
+        self._wake.set()
+
+    def _edge(self, level: int, ticks: int) -> None:
+        self._level = level
+        if not self._bouncing:
+            self._bouncing = True
+            self._edge_start = ticks
+        self._last_edge = ticks
+
+    def _classify(self) -> None:
+        self._window = False
+        tracer.mark("classify")
+        if self._num_presses == 1 and self._num_releases == 1:
+            if not self._speculated:
+                print("got short click %s" % self.pin)
+                launch(self._press_func)
+        elif self._num_presses == 1 and self._num_releases == 0:
+            print("got long press %s" % self.pin)
+            launch(self._long_func)
+        elif self._num_presses == 2:
+            if self._speculated and self._correct_func is not None:
+                print("got double click after speculative click %s" % self.pin)
+                launch(self._correct_func)
+            else:
+                print("got double click %s" % self.pin)
+                launch(self._double_func)
+
+    def _transition(self, state: bool, ticks: int) -> None:
+        if self._window and utime.ticks_diff(ticks, self._deadline) >= 0:
+            self._classify()
+        if state:
+            if not self._window:
+                self._window = True
+                self._deadline = utime.ticks_add(ticks, self.double_click_ms * 1000)
+                self._num_presses = 0
+                self._num_releases = 0
+                self._speculated = False
+            self._num_presses += 1
+        elif self._window:
+            self._num_releases += 1
+            if self._num_presses == 1 and self._num_releases == 1:
+                if self._double_func is None:
+                    self._classify()
+                elif self.speculative:
+                    tracer.mark("classify")
+                    print("got speculative click %s" % self.pin)
+                    self._speculated = True
+                    launch(self._press_func)
+
+    def _poll(self, now: int) -> bool:
+        # Returns True while there is still something to wait for.
+        if self._bouncing and utime.ticks_diff(now, self._last_edge) >= self.debounce_ms * 1000:
+            # Switch has settled; the change happened at the first edge.
+            self._bouncing = False
+            state = bool(self._level ^ self.sense)
+            if state != self.buttonstate:
+                self.buttonstate = state
+                if state and not self._window:
+                    tracer.begin(self._edge_start)
+                    tracer.mark("debounce")
+                self._transition(state, self._edge_start)
+
+        if self._window and utime.ticks_diff(now, self._deadline) >= 0:
+            # Edges that started before the deadline still count.
+            if not (self._bouncing and utime.ticks_diff(self._edge_start, self._deadline) < 0):
+                self._classify()
+
+        return self._bouncing or self._window
+
+
+# Debounces and classifies the edges of every button from one coroutine,
+# using the timestamps recorded by the interrupt handlers.
+class ButtonScanner:
+    poll_ms = 5
+
+    def __init__(self, size: int = 32) -> None:
+        self.ring = EventRing(size)
+        self.wake = asyn.Event()
+        self._buttons: List[Button] = []
+        loop = asyncio.get_event_loop()
+        loop.create_task(self._run())  # Thread runs forever
+
+    def add(self, button: Button) -> int:
+        self._buttons.append(button)
+        return len(self._buttons) - 1
+
+    async def _run(self) -> None:
+        ring = self.ring
+        while True:
+            self.wake.clear()
+            while not ring.is_empty():
+                id, level, ticks = ring.pop()
+                self._buttons[id]._edge(level, ticks)
+
+            now = utime.ticks_us()
+            busy = False
+            for button in self._buttons:
+                if button._poll(now):
+                    busy = True
+
+            if busy:
+                await asyncio.sleep_ms(self.poll_ms)
+            elif ring.is_empty():
+                await self.wake
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "overflows": self.ring.overflows,
+        }
@@ -0,0 +1,577 @@
+import uasyncio as asyncio
+import asyn
+import binascii
+import machine
+import neopixel
+import utime
+
+try:
+    from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar
+    Color = Tuple[int, int, int]
+except ImportError:
+    def TypeVar(*args: None, **kwargs: None) -> None:  # type: ignore
+        pass
+
+NUM_LIGHTS = 16
+FPS = 20
+
+OPAQUE = 255
+TRANSPARENT = 0
+
+
+def _replicate(mv: memoryview, lo: int, hi: int, size: int) -> None:
+    # Repeat the first size bytes of mv[lo:hi] across the rest of it, doubling
+    # the copied region each time.
+    filled = size
+    total = hi - lo
+    while filled < total:
+        step = min(filled, total - filled)
+        mv[lo + filled:lo + filled + step] = mv[lo:lo + step]
+        filled += step
+
+
+# Something that changes a task's pixels over time. The Lights frame clock
+# calls step() every tick; the animation draws a new frame every interval_ms
+# and returns False once it has finished.
+class Animation:
+    def __init__(self, task: 'LightsTask', interval_ms: int) -> None:
+        self.task = task
+        self.interval_ms = interval_ms
+        self._due: Optional[int] = None
+
+    def step(self, now: int) -> bool:
+        if self.task._cancel:
+            return False
+        if self._due is not None and utime.ticks_diff(now, self._due) < 0:
+            return True
+        if self._due is None:
+            self._due = now
+        self._due = utime.ticks_add(self._due, self.interval_ms)
+        return self.frame()
+
+    def frame(self) -> bool:
+        raise NotImplementedError()
+
+    def finished(self) -> None:
+        self.task.stop()
+
+
+# Plays frames from a FrameTable, one per interval_ms, for a number of
+# frames, looping over the table if needed.
+class PlaybackAnimation(Animation):
+    def __init__(
+            self, task: 'LightsTask', table: 'FrameTable', interval_ms: int, frames: int,
+            stop: bool = True) -> None:
+        super().__init__(task, interval_ms)
+        self._table = table
+        self._frames = frames
+        self._stop = stop
+        self._i = 0
+
+    def frame(self) -> bool:
+        if self._i >= self._frames:
+            return False
+        self.task.show_frame(self._table, self._i % len(self._table))
+        self.task.write()
+        self._i += 1
+        return True
+
+    def finished(self) -> None:
+        if self._stop:
+            self.task.stop()
+
+
+# Raw frames for an animation, compiled once and kept in one bytearray with
+# one frame per slice, plus a matching alpha mask for each frame. Frames are
+# recorded by drawing on an off-screen task with the usual operations.
+class FrameTable:
+    def __init__(self, num_lights: int, capacity: int) -> None:
+        self._n = num_lights
+        self._count = 0
+        self._pixels = memoryview(bytearray(capacity * num_lights * 3))
+        self._alpha = memoryview(bytearray(capacity * num_lights))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def record(self, task: 'LightsTask') -> None:
+        i = self._count
+        size = self._n * 3
+        self._pixels[i * size:(i + 1) * size] = task._mv
+        self._alpha[i * self._n:(i + 1) * self._n] = task._alpha_mv
+        self._count += 1
+
+    def pixels(self, index: int) -> memoryview:
+        size = self._n * 3
+        return self._pixels[index * size:(index + 1) * size]
+
+    def alpha(self, index: int) -> memoryview:
+        return self._alpha[index * self._n:(index + 1) * self._n]
+
+
+def rotate_table(lights: 'Lights', color: Color, length: int = 4) -> FrameTable:
+    table = FrameTable(NUM_LIGHTS, NUM_LIGHTS)
+    task = LightsTask(lights, NUM_LIGHTS)
+    for i in range(NUM_LIGHTS):
+        task.clear()
+        task.fill_range(color, i, length)
+        table.record(task)
+    return table
+
+
+def spinner_table(lights: 'Lights', color: Color) -> FrameTable:
+    # A rotating head with a fading tail.
+    tail = (OPAQUE, 160, 96, 48, 16)
+    table = FrameTable(NUM_LIGHTS, NUM_LIGHTS)
+    task = LightsTask(lights, NUM_LIGHTS)
+    for i in range(NUM_LIGHTS):
+        task.clear()
+        for j, alpha in enumerate(tail):
+            task.set_pixel((i - j) % NUM_LIGHTS, color, alpha)
+        table.record(task)
+    return table
+
+
+def flash_table(lights: 'Lights', color: Color) -> FrameTable:
+    table = FrameTable(NUM_LIGHTS, 2)
+    task = LightsTask(lights, NUM_LIGHTS)
+    task.fill(color)
+    table.record(task)
+    task.clear()
+    table.record(task)
+    return table
+
+
+def error_table(lights: 'Lights', color: Color, code: int) -> FrameTable:
+    # Blink code times, then stay dark for three frames.
+    table = FrameTable(NUM_LIGHTS, code * 2 + 3)
+    task = LightsTask(lights, NUM_LIGHTS)
+    for i in range(code):
+        task.fill(color)
+        table.record(task)
+        task.clear()
+        table.record(task)
+    for i in range(3):
+        table.record(task)
+    return table
+
+
+def _draw_timer(task: 'LightsTask', minutes: int) -> None:
+    colors = [(1, 0, 0), (0, 1, 0), (0, 0, 1)]  # type: List[Color]
+    num_lights = (minutes % task.n)
+    num_cycles = (minutes // task.n)
+
+    if num_cycles > len(colors)-1:
+        fg = (1, 1, 1)
+    else:
+        fg = colors[num_cycles]
+
+    if num_cycles == 0:
+        bg = (0, 0, 0)
+    else:
+        prev_cycles = num_cycles - 1
+        if prev_cycles > len(colors)-1:
+            bg = (1, 1, 0)
+        else:
+            bg = colors[prev_cycles]
+
+    task.fill(bg)
+    task.fill_range(fg, 0, num_lights)
+
+
+def timer_table(lights: 'Lights', minutes: int) -> FrameTable:
+    # The current minute, alternating with the next.
+    table = FrameTable(NUM_LIGHTS, 2)
+    task = LightsTask(lights, NUM_LIGHTS)
+    _draw_timer(task, minutes)
+    table.record(task)
+    _draw_timer(task, minutes + 1)
+    table.record(task)
+    return table
+
+
+# One layer of the display. Each task draws into its own pixel buffer and
+# alpha mask; Lights composites the layers and writes the result to the
+# strip. Pixels that have not been drawn, or that were cleared, are
+# transparent and show the layers below.
+#
+# The pixel buffer holds colours in the strip's byte order, so frames can be
+# copied between layers and the strip with slice assignments. The bulk
+# operations below work on the buffer through a memoryview rather than one
+# pixel at a time.
+class LightsTask:
+    def __init__(self, lights: 'Lights', num_lights: int) -> None:
+        self._lights = lights
+        self._n = num_lights
+        self._order = lights.order
+        self._buf = bytearray(num_lights * 3)
+        self._alpha = bytearray(num_lights)
+        self._mv = memoryview(self._buf)
+        self._alpha_mv = memoryview(self._alpha)
+        self._dirty_lo = num_lights
+        self._dirty_hi = 0
+        self._stopped = False
+        self._cancel = False
+
+    def cancel(self) -> None:
+        self._cancel = True
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._lights._stop_task(self)
+
+    @property
+    def is_stopped(self) -> bool:
+        return self._stopped
+
+    def _mark_dirty(self, lo: int, hi: int) -> None:
+        if lo < self._dirty_lo:
+            self._dirty_lo = lo
+        if hi > self._dirty_hi:
+            self._dirty_hi = hi
+
+    def set_pixel(self, index: int, value: Color, alpha: int = OPAQUE) -> None:
+        i = index * 3
+        order = self._order
+        self._buf[i + order[0]] = value[0]
+        self._buf[i + order[1]] = value[1]
+        self._buf[i + order[2]] = value[2]
+        self._alpha[index] = alpha
+        self._mark_dirty(index, index + 1)
+
+    def _fill(self, color: Color, lo: int, hi: int, alpha: int) -> None:
+        if lo >= hi:
+            return
+        self.set_pixel(lo, color, alpha)
+        _replicate(self._mv, lo * 3, hi * 3, 3)
+        _replicate(self._alpha_mv, lo, hi, 1)
+        self._mark_dirty(lo, hi)
+
+    def fill_range(self, color: Color, start: int, count: int, alpha: int = OPAQUE) -> None:
+        # Fill count pixels from start, wrapping around the ring.
+        n = self._n
+        if count >= n:
+            self._fill(color, 0, n, alpha)
+            return
+        start = start % n
+        end = start + count
+        if end > n:
+            self._fill(color, start, n, alpha)
+            self._fill(color, 0, end - n, alpha)
+        else:
+            self._fill(color, start, end, alpha)
+
+    def fill(self, color: Color) -> None:
+        self._fill(color, 0, self._n, OPAQUE)
+
+    def clear_range(self, start: int, count: int) -> None:
+        self.fill_range((0, 0, 0), start, count, TRANSPARENT)
+
+    def clear(self) -> None:
+        self._fill((0, 0, 0), 0, self._n, TRANSPARENT)
+
+    def shift(self, count: int) -> None:
+        # Rotate the layer around the ring by count pixels.
+        n = self._n
+        count = count % n
+        if count == 0:
+            return
+        scratch = self._lights._scratch
+        for mv, size in ((self._mv, 3), (self._alpha_mv, 1)):
+            length = n * size
+            split = count * size
+            scratch[:length] = mv
+            mv[split:length] = scratch[:length - split]
+            mv[:split] = scratch[length - split:length]
+        self._mark_dirty(0, n)
+
+    def show_frame(self, table: FrameTable, index: int) -> None:
+        self._mv[:] = table.pixels(index)
+        self._alpha_mv[:] = table.alpha(index)
+        self._mark_dirty(0, self._n)
+
+    def _blit(self, frame: memoryview, offset: int, lo: int, hi: int, alpha: int) -> None:
+        if lo >= hi:
+            return
+        self._mv[lo * 3:hi * 3] = frame[offset * 3:(offset + hi - lo) * 3]
+        self._alpha[lo] = alpha
+        _replicate(self._alpha_mv, lo, hi, 1)
+        self._mark_dirty(lo, hi)
+
+    def blit(self, frame: bytes, start: int = 0, alpha: int = OPAQUE) -> None:
+        # Copy a frame already in strip byte order, such as one made by
+        # Lights.pack(), into the layer from pixel start, wrapping around
+        # the ring. Only the first lap of a frame longer than the ring is
+        # drawn.
+        n = self._n
+        count = len(frame) // 3
+        if count > n:
+            count = n
+        start = start % n
+        end = start + count
+        mv = memoryview(frame)
+        if end > n:
+            self._blit(mv, 0, start, n, alpha)
+            self._blit(mv, n - start, 0, end - n, alpha)
+        else:
+            self._blit(mv, 0, start, end, alpha)
+
+    @property
+    def n(self) -> int:
+        return self._n
+
+    def __getitem__(self, index: int) -> Color:
+        i = index * 3
+        order = self._order
+        return (self._buf[i + order[0]], self._buf[i + order[1]], self._buf[i + order[2]])
+
+    def __setitem__(self, index: int, value: Color) -> None:
+        self.set_pixel(index, value)
+
+    def __str__(self) -> str:
+        return binascii.hexlify(self._buf).decode()
+
+    def write(self) -> None:
+        self._lights.show()
+
+    def play(self, table: FrameTable, delay: float, frames: int, stop: bool = True) -> None:
+        self._lights.animate(PlaybackAnimation(self, table, int(delay * 1000), frames, stop))
+
+    def rotate(self, color: Color, delay: float) -> None:
+        table = self._lights.frame_table(("rotate", color), rotate_table, color)
+        self.play(table, delay, int(10 / delay))
+
+    def flash(self, color: Color, repeats: int, delay: float) -> None:
+        table = self._lights.frame_table(("flash", color), flash_table, color)
+        self.play(table, delay, repeats * 2)
+
+
+class LightsTaskTimer(LightsTask):
+
+    def set_timer(self, minutes: int, no_flash: bool = False) -> None:
+        if no_flash:
+            _draw_timer(self, minutes)
+            self.write()
+        else:
+            # Flash the next minute twice, finishing on the current one.
+            # we don't call stop here as display expected to continue
+            self.play(timer_table(self._lights, minutes), 0.5, 5, stop=False)
+
+
+class LightsTaskStatus(LightsTask):
+
+    def set_warn(self) -> None:
+        color = (0, 0, 31)
+        self.flash(color, 4, 0.2)
+
+    def set_ok(self) -> None:
+        color = (0, 31, 0)
+        self.flash(color, 1, 0.2)
+
+    def set_danger(self) -> None:
+        color = (31, 0, 0)
+        self.flash(color, 4, 0.2)
+
+    def set_error(self, code: int) -> None:
+        color = (31, 0, 0)
+        table = self._lights.frame_table(("error", code), error_table, color, code)
+        self.play(table, 0.3, len(table) * 2)
+
+
+class LightsTaskColor(LightsTask):
+    # A static colour needs no animation; it stays until cancelled or stopped.
+    def cancel(self) -> None:
+        super().cancel()
+        self.stop()
+
+    def set_color(self, color: Color) -> None:
+        self.fill(color)
+        self.write()
+
+
+class LightsTaskButtonColor(LightsTask):
+
+    def set_button_colors(self, number: int, colors: List[Color]) -> None:
+        # The frame clock coalesces repeated calls into one strip write.
+        number = number*4 + 2
+        self[(number+0) % self._n] = colors[0]
+        self[(number+1) % self._n] = colors[1]
+        self[(number+2) % self._n] = colors[2]
+        self[(number+3) % self._n] = colors[3]
+        self.write()
+
+
+class LightsTaskBoot(LightsTask):
+
+    def set_boot(self) -> None:
+        color = (1, 0, 0)
+        table = self._lights.frame_table(("spinner", color), spinner_table, color)
+        self.play(table, 0.1, 100)
+
+
+# Owns the strip, whose buffer is the single framebuffer. Tasks are layers
+# in z-order, the last one on top. Only pixels that a layer has changed
+# since the last show() are composited, and the strip is only written if
+# the composited output differs from what is already displayed.
+#
+# A single frame clock running at fps steps every active animation and
+# shows the result, so the strip is written at most once per tick. When
+# nothing is animating the clock waits until a task asks to be shown. asyn's
+# Event waits by polling, every scheduler pass with the default delay_ms of
+# 0, so the idle clock only checks it once a frame.
+class Lights:
+    def __init__(self, pin: machine.Pin, fps: int = FPS) -> None:
+        self._np = neopixel.NeoPixel(pin, NUM_LIGHTS, timing=True)
+        self.order = self._np.ORDER
+        self._scratch = memoryview(bytearray(NUM_LIGHTS * 3))
+        self._tables = {}  # type: Dict[Any, FrameTable]
+        self._tasks = []  # type: List[LightsTask]
+        self._animations = []  # type: List[Animation]
+        self._all_dirty = True
+        self._show_pending = False
+        self.frame_ms = 1000 // fps
+        self._event = asyn.Event(self.frame_ms)
+        self.writes = 0
+        self.ticks = 0
+        self.overruns = 0
+        self.max_frame_us = 0
+        loop = asyncio.get_event_loop()
+        loop.create_task(self._run())  # Thread runs forever
+
+    T = TypeVar('T', bound=LightsTask)
+
+    def create_task(self, task_type: Type[T]) -> 'T':
+        task = task_type(self, NUM_LIGHTS)
+        self._tasks.append(task)
+        return task
+
+    def create_bg_task(self, task_type: Type[T]) -> 'T':
+        task = task_type(self, NUM_LIGHTS)
+        self._tasks.insert(0, task)
+        return task
+
+    def _stop_task(self, task: LightsTask) -> None:
+        if task not in self._tasks:
+            return
+        self._tasks.remove(task)
+        self._all_dirty = True
+        self.show()
+
+    def animate(self, animation: Animation) -> None:
+        self._animations.append(animation)
+        self._event.set()
+
+    def show(self) -> None:
+        # Written on the next tick of the frame clock.
+        self._show_pending = True
+        self._event.set()
+
+    def _tick(self, now: int) -> None:
+        for animation in list(self._animations):
+            if not animation.step(now):
+                self._animations.remove(animation)
+                animation.finished()
+        if self._show_pending:
+            self._show_pending = False
+            self._show()
+
+    async def _run(self) -> None:
+        while True:
+            if not self._animations and not self._show_pending:
+                await self._event
+            self._event.clear()
+
+            start = utime.ticks_us()
+            self._tick(utime.ticks_ms())
+            self.ticks += 1
+            frame_us = utime.ticks_diff(utime.ticks_us(), start)
+            if frame_us > self.max_frame_us:
+                self.max_frame_us = frame_us
+            if frame_us > self.frame_ms * 1000:
+                self.overruns += 1
+
+            delay = self.frame_ms - frame_us // 1000
+            await asyncio.sleep_ms(delay if delay > 0 else 0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "frame_budget_us": self.frame_ms * 1000,
+            "max_frame_us": self.max_frame_us,
+            "overruns": self.overruns,
+            "ticks": self.ticks,
+            "writes": self.writes,
+        }
+
+    def frame_table(self, key: Any, build: Callable[..., FrameTable], *args: Any) -> FrameTable:
+        # Compile a table the first time it is needed, and reuse it after.
+        table = self._tables.get(key)
+        if table is None:
+            table = build(self, *args)
+            self._tables[key] = table
+        return table
+
+    def pack(self, colors: List[Color]) -> bytearray:
+        # Convert colours to a frame in strip byte order, for blit().
+        order = self.order
+        frame = bytearray(len(colors) * 3)
+        for index, color in enumerate(colors):
+            i = index * 3
+            frame[i + order[0]] = color[0]
+            frame[i + order[1]] = color[1]
+            frame[i + order[2]] = color[2]
+        return frame
+
+    def _composite(self, index: int) -> bool:
+        # Blend from the top layer down, stopping at the first opaque pixel.
+        i = index * 3
+        c0 = c1 = c2 = 0
+        cover = OPAQUE
+        for task in reversed(self._tasks):
+            alpha = task._alpha[index]
+            if alpha == TRANSPARENT:
+                continue
+            buf = task._buf
+            if cover == OPAQUE and alpha == OPAQUE:
+                c0 = buf[i]
+                c1 = buf[i + 1]
+                c2 = buf[i + 2]
+                break
+            weight = cover * alpha // OPAQUE
+            c0 += buf[i] * weight // OPAQUE
+            c1 += buf[i + 1] * weight // OPAQUE
+            c2 += buf[i + 2] * weight // OPAQUE
+            cover -= weight
+            if cover <= 0:
+                break
+
+        out = self._np.buf
+        if out[i] == c0 and out[i + 1] == c1 and out[i + 2] == c2:
+            return False
+        out[i] = c0
+        out[i + 1] = c1
+        out[i + 2] = c2
+        return True
+
+    def _show(self) -> None:
+        lo = NUM_LIGHTS
+        hi = 0
+        if self._all_dirty:
+            lo = 0
+            hi = NUM_LIGHTS
+            self._all_dirty = False
+        for task in self._tasks:
+            if task._dirty_lo < lo:
+                lo = task._dirty_lo
+            if task._dirty_hi > hi:
+                hi = task._dirty_hi
+            task._dirty_lo = NUM_LIGHTS
+            task._dirty_hi = 0
+
+        changed = False
+        for index in range(lo, hi):
+            if self._composite(index):
+                changed = True
+
+        if changed:
+            self._np.write()
+            self.writes += 1
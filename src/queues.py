@@ -0,0 +1,238 @@
+import uasyncio as asyncio
+import asyn
+import utime
+from mqtt_as import MQTTClient
+
+try:
+    from typing import Any, Awaitable, Callable, Optional
+    MessageHandler = Callable[[bytes, bytes, bool], Awaitable[None]]
+except ImportError:
+    pass
+
+
+# Values waiting to be processed, in arrival order. Only the latest value for
+# each key is kept, and at most size keys can be waiting; when full, the key
+# that has waited longest is dropped.
+class CoalescingQueue:
+    size: int
+    coalesced: int
+    dropped: int
+    max_depth: int
+    _order: list[bytes]
+    _pending: dict[bytes, Any]
+    _event: asyn.Event
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.coalesced = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self._order = []
+        self._pending = {}
+        self._event = asyn.Event()
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def _merge(self, old: Any, new: Any) -> Any:
+        return new
+
+    def _put(self, key: bytes, value: Any) -> None:
+        if key in self._pending:
+            value = self._merge(self._pending[key], value)
+            self.coalesced += 1
+        else:
+            if len(self._order) >= self.size:
+                oldest = self._order.pop(0)
+                del self._pending[oldest]
+                self.dropped += 1
+            self._order.append(key)
+            if len(self._order) > self.max_depth:
+                self.max_depth = len(self._order)
+        self._pending[key] = value
+        self._event.set()
+
+    def _pop(self) -> tuple[bytes, Any]:
+        key = self._order.pop(0)
+        return key, self._pending.pop(key)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "depth": len(self._order),
+            "max_depth": self.max_depth,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
+
+
+# Inbound MQTT messages, drained by a single worker coroutine.
+class InboundQueue(CoalescingQueue):
+    _handler: MessageHandler
+
+    def __init__(self, size: int, handler: MessageHandler) -> None:
+        super().__init__(size)
+        self._handler = handler
+
+    def _merge(self, old: Any, new: Any) -> Any:
+        # Keep the retained flag so the cache still sees the new value.
+        message, retained = new
+        return (message, retained or old[1])
+
+    def put(self, topic: bytes, message: bytes, retained: bool) -> None:
+        self._put(topic, (message, retained))
+
+    async def run(self) -> None:
+        while True:
+            await self._event
+            self._event.clear()
+            while self._order:
+                topic, (message, retained) = self._pop()
+                try:
+                    await self._handler(topic, message, retained)
+                except ValueError as e:
+                    print("JSON Error %s" % e)
+                except Exception as e:
+                    print("InboundQueue.run() error %s" % e)
+
+
+# Outbound MQTT messages, published by a single writer coroutine. A message
+# replaces one still waiting with the same key, by default its topic.
+# Messages queued while the broker is unreachable are kept, and sent in one
+# burst once the link is back up. A message that fails to publish goes back
+# to the head of the queue, unless a newer one has replaced it, and is
+# dropped after max_attempts. waited_ms is the total time the writer has
+# spent waiting for the link, link_up_ms when it last came back and sent_ms
+# when a message was last published.
+class OutboundQueue(CoalescingQueue):
+    retry_ms = 500
+    max_attempts = 3
+
+    published: int
+    failed: int
+    last_latency_ms: Optional[int]
+    max_latency_ms: int
+    waited_ms: int
+    link_up_ms: int
+    sent_ms: int
+    _client: MQTTClient
+    _sending: Optional[bytes]
+    _drained: asyn.Event
+    _waiters: list[tuple[list[bytes], asyn.Event]]
+
+    def __init__(self, size: int, client: MQTTClient) -> None:
+        super().__init__(size)
+        self.published = 0
+        self.failed = 0
+        self.last_latency_ms = None
+        self.max_latency_ms = 0
+        self.waited_ms = 0
+        self.link_up_ms = utime.ticks_ms()
+        self.sent_ms = self.link_up_ms
+        self._client = client
+        self._sending = None
+        self._drained = asyn.Event()
+        self._waiters = []
+
+    def put(self, topic: bytes, message: bytes, key: Optional[bytes] = None) -> None:
+        self._drained.clear()
+        self._put(topic if key is None else key, (topic, message, utime.ticks_ms(), 1))
+
+    def _retry(self, key: bytes, value: Any) -> bool:
+        # Returns False if the message has been given up on.
+        topic, message, queued, attempts = value
+        if key in self._pending:
+            # Replaced while it was being sent.
+            return True
+        if attempts >= self.max_attempts:
+            print("OutboundQueue.run() dropped", topic)
+            self.failed += 1
+            return False
+        self._order.insert(0, key)
+        self._pending[key] = (topic, message, queued, attempts + 1)
+        return True
+
+    async def flushed(self) -> None:
+        # Wait until everything queued so far has been published.
+        while self._order or self._sending is not None:
+            await self._drained
+
+    def _is_waiting(self, keys: list[bytes]) -> bool:
+        for key in keys:
+            if key == self._sending or key in self._pending:
+                return True
+        return False
+
+    def _wake(self, dropped: Optional[bytes] = None) -> None:
+        # Wake the callers of sent() whose messages are all out of the queue,
+        # or one of which has just been dropped.
+        for waiter in self._waiters[:]:
+            keys, event = waiter
+            if dropped is not None and dropped in keys:
+                self._waiters.remove(waiter)
+                event.set(None)
+            elif not self._is_waiting(keys):
+                self._waiters.remove(waiter)
+                event.set(self.sent_ms)
+
+    async def _timeout(self, waiter: tuple[list[bytes], asyn.Event], timeout_ms: int) -> None:
+        await asyncio.sleep_ms(timeout_ms)
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+            waiter[1].set(None)
+
+    async def sent(self, keys: list[bytes], timeout_ms: int = 10000) -> Optional[int]:
+        # Wait until the messages queued so far for keys have been
+        # published, however much else is waiting behind them. Returns when
+        # the last of them was published, or None if one was dropped or it
+        # took longer than timeout_ms.
+        if not self._is_waiting(keys):
+            return self.sent_ms
+        waiter = (keys, asyn.Event())
+        self._waiters.append(waiter)
+        asyncio.get_event_loop().create_task(self._timeout(waiter, timeout_ms))
+        await waiter[1]
+        result: Optional[int] = waiter[1].value()
+        return result
+
+    async def run(self) -> None:
+        while True:
+            await self._event
+            self._event.clear()
+            while self._order:
+                if not self._client.isconnected():
+                    waiting = utime.ticks_ms()
+                    while not self._client.isconnected():
+                        await asyncio.sleep_ms(self.retry_ms)
+                    self.link_up_ms = utime.ticks_ms()
+                    self.waited_ms += utime.ticks_diff(self.link_up_ms, waiting)
+                key, value = self._pop()
+                topic, message, queued, attempts = value
+                self._sending = key
+                try:
+                    await self._client.publish(topic, message, qos=0)
+                except Exception as e:
+                    print("OutboundQueue.run() error %s" % e)
+                    self._sending = None
+                    if not self._retry(key, value):
+                        self._wake(key)
+                    await asyncio.sleep_ms(self.retry_ms)
+                    continue
+                finally:
+                    self._sending = None
+                self.sent_ms = utime.ticks_ms()
+                self._wake()
+                latency = utime.ticks_diff(self.sent_ms, queued)
+                self.published += 1
+                self.last_latency_ms = latency
+                if latency > self.max_latency_ms:
+                    self.max_latency_ms = latency
+            self._drained.set()
+
+    def stats(self) -> dict[str, Any]:
+        result = super().stats()
+        result["published"] = self.published
+        result["failed"] = self.failed
+        result["last_latency_ms"] = self.last_latency_ms
+        result["max_latency_ms"] = self.max_latency_ms
+        result["waited_ms"] = self.waited_ms
+        return result
@@ -0,0 +1,143 @@
+import uasyncio as asyncio
+import os
+import struct
+import utime
+
+try:
+    from typing import Iterator, Tuple
+    Entry = Tuple[int, bytes, bytes, bool]
+except ImportError:
+    pass
+
+MAGIC = b"MQR1"
+
+# Each entry: ticks_ms, flags, topic length, payload length, then the topic
+# and payload bytes.
+HEADER = "<IBBH"
+HEADER_SIZE = struct.calcsize(HEADER)
+RETAINED = 0x01
+
+
+# Records every message received, as (ticks_ms, topic, payload, retained),
+# to a ring on flash made of two files: path, and path + ".old" holding the
+# entries before it. When path grows past half of size_bytes it replaces
+# path + ".old", so at most size_bytes are kept and the oldest entries are
+# dropped first.
+#
+# record() is called for every message, from the MQTT receive loop, so it
+# only copies the entry into a RAM buffer and never touches flash. run()
+# writes the buffer out every flush_ms, or sooner once it is half full.
+# Entries that do not fit in the buffer are counted as skipped.
+class Recorder:
+    flush_ms = 5000
+    poll_ms = 100
+
+    def __init__(self, path: str, size_bytes: int, buffer_bytes: int = 1024) -> None:
+        self.path = path
+        self.segment_bytes = size_bytes // 2
+        self.recorded = 0
+        self.skipped = 0
+        self.flushes = 0
+        self._buf = bytearray(buffer_bytes)
+        self._mv = memoryview(self._buf)
+        self._len = 0
+        try:
+            self._size = os.stat(path)[6]
+        except OSError:
+            self._size = 0
+
+    def record(self, topic: bytes, payload: bytes, retained: bool) -> None:
+        topic_len = len(topic)
+        payload_len = len(payload)
+        if topic_len > 0xff or payload_len > 0xffff:
+            self.skipped += 1
+            return
+        size = HEADER_SIZE + topic_len + payload_len
+        if self._len + size > len(self._buf):
+            self.skipped += 1
+            return
+
+        i = self._len
+        struct.pack_into(
+            HEADER, self._buf, i, utime.ticks_ms(), RETAINED if retained else 0, topic_len, payload_len)
+        i += HEADER_SIZE
+        self._mv[i:i + topic_len] = topic
+        i += topic_len
+        self._mv[i:i + payload_len] = payload
+        self._len = i + payload_len
+        self.recorded += 1
+
+    def flush(self) -> None:
+        if not self._len:
+            return
+        if self._size + self._len > self.segment_bytes:
+            self._rotate()
+        with open(self.path, "ab") as file:
+            if self._size == 0:
+                file.write(MAGIC)
+                self._size = len(MAGIC)
+            file.write(self._mv[:self._len])
+        self._size += self._len
+        self._len = 0
+        self.flushes += 1
+
+    def _rotate(self) -> None:
+        old = self.path + ".old"
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+        try:
+            os.rename(self.path, old)
+        except OSError:
+            pass
+        self._size = 0
+
+    async def run(self) -> None:
+        last = utime.ticks_ms()
+        while True:
+            await asyncio.sleep_ms(self.poll_ms)
+            if self._len * 2 < len(self._buf) and utime.ticks_diff(utime.ticks_ms(), last) < self.flush_ms:
+                continue
+            last = utime.ticks_ms()
+            try:
+                self.flush()
+            except OSError as e:
+                print("Recorder.run() error %s" % e)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "recorded": self.recorded,
+            "skipped": self.skipped,
+            "flushes": self.flushes,
+            "bytes": self._size,
+        }
+
+
+def _read_file(path: str) -> Iterator[Entry]:
+    try:
+        file = open(path, "rb")
+    except OSError:
+        return
+    with file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a capture" % path)
+        while True:
+            header = file.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE:
+                # A partial entry at the end is from an interrupted write.
+                return
+            ticks, flags, topic_len, payload_len = struct.unpack(HEADER, header)
+            topic = file.read(topic_len)
+            payload = file.read(payload_len)
+            if len(topic) < topic_len or len(payload) < payload_len:
+                return
+            yield ticks, topic, payload, bool(flags & RETAINED)
+
+
+def read(path: str) -> Iterator[Entry]:
+    # Every entry of a capture, oldest first.
+    for entry in _read_file(path + ".old"):
+        yield entry
+    for entry in _read_file(path):
+        yield entry
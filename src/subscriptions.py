@@ -1,70 +1,400 @@
-import json
+import formats
+import uasyncio as asyncio
+import asyn
+import utime
+from collections import OrderedDict
 from mqtt_as import MQTTClient
+from tracing import tracer
 
 try:
-    from typing import Callable, Any, Awaitable, List
-    Callback = Callable[[List[str], str, Any], Awaitable[None]]
+    from typing import Callable, Any, Awaitable, Iterator, Optional
+    Callback = Callable[[bytes, str, Any], Awaitable[None]]
     SubscriptionDetails = tuple[str, Callback, str]
 except ImportError:
     pass
 
 
-def _get_message_format(message_str: str, format: str) -> Any:
-    if format == "json":
-        return json.loads(message_str)
-    elif format == "raw":
-        return message_str
-    else:
-        raise RuntimeError("Unknown message format %s" % format)
+def _get_message_format(message_bytes: bytes, format: str) -> Any:
+    return formats.decode(message_bytes, format)
 
 
-async def _send_to_client(topic: list[str], label: Any, callback: Callback, format: str, message_str: str) -> None:
-    message = _get_message_format(message_str, format)
-    await callback(topic, label, message)
+def _heap_size(value: Any) -> int:
+    # Roughly how much heap a decoded value takes.
+    if value is None or isinstance(value, (bool, int)):
+        return 0
+    if isinstance(value, (str, bytes)):
+        return 16 + len(value)
+    if isinstance(value, list):
+        size = 16 + 4 * len(value)
+        for item in value:
+            size += _heap_size(item)
+        return size
+    if isinstance(value, dict):
+        size = 32 + 8 * len(value)
+        for key, item in value.items():
+            size += _heap_size(key) + _heap_size(item)
+        return size
+    return 16
 
 
+# A received message, decoded at most once per format, and not at all until
+# a subscriber asks for it. The same object is shared by every subscriber of
+# the message, and kept in the retained cache for later subscribers.
+class Message:
+    payload: bytes
+    _decoded: Optional[dict[str, Any]]
+
+    def __init__(self, payload: bytes) -> None:
+        self.payload = payload
+        self._decoded = None
+
+    def get(self, format: str) -> Any:
+        if self._decoded is None:
+            self._decoded = {}
+        elif format in self._decoded:
+            return self._decoded[format]
+        message = _get_message_format(self.payload, format)
+        self._decoded[format] = message
+        return message
+
+    def heap_size(self) -> int:
+        size = len(self.payload)
+        if self._decoded is not None:
+            for value in self._decoded.values():
+                size += _heap_size(value)
+        return size
+
+
+# Subscribers are given the topic as received. Those that need its levels
+# split it themselves.
+def topic_levels(topic_bytes: bytes) -> list[str]:
+    return topic_bytes.decode("UTF8").split("/")
+
+
+RETAINED_CACHE_BYTES = 4096
+
+
+def _is_wildcard(topic: list[str]) -> bool:
+    return "+" in topic or "#" in topic
+
+
+def _filter_matches(topic_filter: list[str], topic: list[str]) -> bool:
+    if topic[0].startswith("$") and topic_filter[0] in ("+", "#"):
+        return False
+    for i, level in enumerate(topic_filter):
+        if level == "#":
+            return True
+        if i >= len(topic):
+            return False
+        if level != "+" and level != topic[i]:
+            return False
+    return len(topic_filter) == len(topic)
+
+
+# Last retained message for each topic, so later subscribers get the last
+# value without asking the broker, or decoding it again in a format it has
+# already been decoded in. The cache is limited to budget bytes of topic,
+# payload and an estimate of the decoded values, which for JSON lists take
+# several times as much heap as the payload; the least recently used topics
+# are evicted first. decode() keeps the estimate up to date when a replay
+# decodes a message in a new format.
+# Topics that were subscribed to by name are pinned and never evicted;
+# topics only seen through a wildcard filter may be.
+class RetainedCache:
+    budget: int
+    size: int
+    hits: int
+    misses: int
+    evictions: int
+    _entries: 'OrderedDict[bytes, tuple[Message, int]]'
+    _pinned: set[bytes]
+
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._pinned = set()
+
+    def pin(self, topic_bytes: bytes) -> None:
+        self._pinned.add(topic_bytes)
+
+    def _remove(self, topic_bytes: bytes) -> None:
+        _, size = self._entries.pop(topic_bytes)
+        self.size -= size
+
+    def put(self, topic_bytes: bytes, message: Message) -> None:
+        if topic_bytes in self._entries:
+            self._remove(topic_bytes)
+        size = len(topic_bytes) + message.heap_size()
+        self._entries[topic_bytes] = (message, size)
+        self.size += size
+        if self.size > self.budget:
+            self._evict()
+
+    def _evict(self) -> None:
+        for topic_bytes in list(self._entries.keys()):
+            if self.size <= self.budget:
+                break
+            if topic_bytes not in self._pinned:
+                self._remove(topic_bytes)
+                self.evictions += 1
+
+    def get(self, topic_bytes: bytes) -> Optional[Message]:
+        entry = self._entries.get(topic_bytes)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Move to the most recently used end.
+        del self._entries[topic_bytes]
+        self._entries[topic_bytes] = entry
+        return entry[0]
+
+    def matching(self, topic_filter: list[str]) -> list[tuple[bytes, Message]]:
+        result = [
+            (topic_bytes, entry[0]) for topic_bytes, entry in self._entries.items()
+            if _filter_matches(topic_filter, topic_levels(topic_bytes))
+        ]
+        if result:
+            self.hits += len(result)
+        else:
+            self.misses += 1
+        return result
+
+    def decode(self, topic_bytes: bytes, message: Message, format: str) -> Any:
+        # A cached message in format, counting the decoded value against
+        # the budget if it is new.
+        value = message.get(format)
+        entry = self._entries.get(topic_bytes)
+        if entry is not None and entry[0] is message:
+            size = len(topic_bytes) + message.heap_size()
+            if size != entry[1]:
+                self._entries[topic_bytes] = (message, size)
+                self.size += size - entry[1]
+                if self.size > self.budget:
+                    self._evict()
+        return value
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# One level of a subscription filter. A node with a filter_str is a
+# subscribed filter; filter_bytes is the same filter as received topics
+# spell it, and wildcard is set if it has a "+" or "#" level.
+class TopicNode:
+    children: dict[str, 'TopicNode']
+    filter_str: Optional[str]
+    filter_bytes: Optional[bytes]
+    wildcard: bool
+    subscriptions: list[SubscriptionDetails]
+
+    def __init__(self) -> None:
+        self.children = {}
+        self.filter_str = None
+        self.filter_bytes = None
+        self.wildcard = False
+        self.subscriptions = []
+
+
+# Subscription filters, supporting the MQTT "+" and "#" wildcards.
+class TopicTrie:
+    _root: TopicNode
+
+    def __init__(self) -> None:
+        self._root = TopicNode()
+
+    def insert(self, topic: list[str]) -> TopicNode:
+        node = self._root
+        for level in topic:
+            child = node.children.get(level)
+            if child is None:
+                child = TopicNode()
+                node.children[level] = child
+            node = child
+        if node.filter_str is None:
+            node.filter_str = "/".join(topic)
+            node.filter_bytes = node.filter_str.encode("UTF8")
+            node.wildcard = _is_wildcard(topic)
+        return node
+
+    def filters(self) -> Iterator[TopicNode]:
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node.filter_str is not None:
+                yield node
+            stack.extend(node.children.values())
+
+    def match(self, topic: list[str]) -> list[TopicNode]:
+        # Find every filter matching topic, in one walk down the trie.
+        matches: list[TopicNode] = []
+        nodes = [self._root]
+        # Wildcards at the first level must not match "$SYS" style topics.
+        wildcards = not topic[0].startswith("$")
+
+        for level in topic:
+            next_nodes: list[TopicNode] = []
+            for node in nodes:
+                if wildcards:
+                    child = node.children.get("#")
+                    if child is not None:
+                        matches.append(child)
+                    child = node.children.get("+")
+                    if child is not None:
+                        next_nodes.append(child)
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+            if not next_nodes:
+                return matches
+            nodes = next_nodes
+            wildcards = True
+
+        for node in nodes:
+            matches.append(node)
+            # "a/#" also matches the parent level "a".
+            child = node.children.get("#")
+            if child is not None:
+                matches.append(child)
+        return matches
+
+
+# Incoming messages are dispatched on the topic bytes as received from
+# mqtt_as. Filters without wildcards, which is nearly all of them, are found
+# with a single dict lookup; the topic is only decoded and split to walk the
+# trie if a wildcard filter has been subscribed. Nothing is allocated for a
+# message nobody subscribed to, and the payload is not decoded until a
+# subscriber asks for it.
 class Subscriptions:
+    # Maximum number of SUBSCRIBE packets in flight at once.
+    batch_size = 16
+
     _client: MQTTClient
-    _subscriptions: dict[str, list[SubscriptionDetails]]
-    _last_message: dict[str, str]
+    _trie: TopicTrie
+    _exact: dict[bytes, TopicNode]
+    _wildcards: int
+    _pending: list[str]
+    time_to_ready_ms: Optional[int]
+    retained: RetainedCache
 
-    def __init__(self, client: MQTTClient) -> None:
+    def __init__(self, client: MQTTClient, cache_bytes: int = RETAINED_CACHE_BYTES) -> None:
         print("Subscription.__init__()")
         self._client = client
-        self._subscriptions = {}
-        self._last_message = {}
+        self._trie = TopicTrie()
+        self._exact = {}
+        self._wildcards = 0
+        self._pending = []
+        self.time_to_ready_ms = None
+        self.retained = RetainedCache(cache_bytes)
 
-    async def connected(self) -> None:
-        print("Subscription.connect()")
-        for topic_str in self._subscriptions.keys():
-            print("Subscription.connect() subscribing to {}".format(topic_str))
+    async def _subscribe_one(self, topic_str: str, counter: list[int], done: asyn.Event) -> None:
+        try:
             await self._client.subscribe(topic_str, 0)
+        finally:
+            counter[0] -= 1
+            if counter[0] <= 0:
+                done.set()
+
+    async def _subscribe_batch(self, topics: list[str]) -> None:
+        # mqtt_as only parses a SUBACK with a single return code, so rather
+        # than packing several filters into one packet, the SUBSCRIBEs are
+        # written back to back and the SUBACKs awaited together. This costs
+        # one broker round trip per batch instead of one per filter.
+        start = utime.ticks_ms()
+        loop = asyncio.get_event_loop()
+
+        for i in range(0, len(topics), self.batch_size):
+            batch = topics[i:i + self.batch_size]
+            counter = [len(batch)]
+            done = asyn.Event()
+            for topic_str in batch:
+                print("Subscription._subscribe_batch() subscribing to {}".format(topic_str))
+                loop.create_task(self._subscribe_one(topic_str, counter, done))
+            await done
+
+        self.time_to_ready_ms = utime.ticks_diff(utime.ticks_ms(), start)
+        print("Subscription._subscribe_batch() {} topics ready in {} ms".format(
+            len(topics), self.time_to_ready_ms))
+
+    async def connected(self) -> None:
+        print("Subscription.connect()", self.retained.stats())
+        topics = [node.filter_str for node in self._trie.filters() if node.filter_str is not None]
+        self._pending = []
+        if topics:
+            await self._subscribe_batch(topics)
+
+    async def flush(self) -> None:
+        # Send every filter added by subscribe() since the last flush.
+        topics = self._pending
+        self._pending = []
+        if topics:
+            await self._subscribe_batch(topics)
 
     async def subscribe(self, topic: list[str], label: Any, callback: Callback, format: str) -> None:
+        # The broker is not told until flush() is called.
         print("Subscription.subscribe()")
-        topic_str = "/".join(topic)
-        subscriptions: list[SubscriptionDetails] = []
+        node = self._trie.insert(topic)
+        topic_str = node.filter_str
+        topic_bytes = node.filter_bytes
 
-        if topic_str in self._subscriptions:
+        if node.subscriptions:
             print("Subscription.subscribe(): Adding subscription to {}.".format(topic_str))
-            subscriptions = self._subscriptions[topic_str]
-        else:
+        elif topic_str is not None and topic_str not in self._pending:
             print("Subscription.subscribe(): Creating subscription to {}.".format(topic_str))
-            await self._client.subscribe(topic_str, 0)
-            print("Subscription.subscribe(): Done creating subscription to {}.".format(topic_str))
+            self._pending.append(topic_str)
 
-        subscriptions = subscriptions + [(label, callback, format)]
-        self._subscriptions[topic_str] = subscriptions
+        if not node.subscriptions:
+            if node.wildcard:
+                self._wildcards += 1
+            elif topic_bytes is not None:
+                self._exact[topic_bytes] = node
 
-        if topic_str in self._last_message:
-            raw = self._last_message[topic_str]
-            await _send_to_client(topic, label, callback, format, raw)
+        node.subscriptions = node.subscriptions + [(label, callback, format)]
+
+        if node.wildcard:
+            for retained_topic, retained_message in self.retained.matching(topic):
+                await callback(retained_topic, label, self.retained.decode(retained_topic, retained_message, format))
+        elif topic_bytes is not None:
+            self.retained.pin(topic_bytes)
+            cached = self.retained.get(topic_bytes)
+            if cached is not None:
+                await callback(topic_bytes, label, self.retained.decode(topic_bytes, cached, format))
+
+    async def _dispatch(self, node: TopicNode, topic_bytes: bytes, message: Message) -> None:
+        for label, callback, format in node.subscriptions:
+            await callback(topic_bytes, label, message.get(format))
 
     async def message(self, topic_bytes: bytes, message_bytes: bytes, retained: bool) -> None:
-        topic_str = topic_bytes.decode("UTF8")
-        message_str = message_bytes.decode("UTF8")
-        topic = topic_str.split("/")
-        if retained:
-            self._last_message[topic_str] = message_str
-        for label, callback, format in self._subscriptions.get(topic_str, []):
-            await _send_to_client(topic, label, callback, format, message_str)
+        tracer.state(topic_bytes)
+        node = self._exact.get(topic_bytes)
+        nodes = None
+        if self._wildcards:
+            nodes = [
+                match for match in self._trie.match(topic_levels(topic_bytes))
+                if match.wildcard and match.subscriptions
+            ]
+        if node is None and not nodes:
+            return
+
+        message = Message(message_bytes)
+        try:
+            if node is not None:
+                await self._dispatch(node, topic_bytes, message)
+            if nodes:
+                for node in nodes:
+                    await self._dispatch(node, topic_bytes, message)
+        finally:
+            # Cached once decoded, so the budget counts the decoded values.
+            if retained:
+                self.retained.put(topic_bytes, message)
@@ -0,0 +1,136 @@
+import array
+import utime
+
+try:
+    from typing import Any, Dict, List, Optional
+except ImportError:
+    pass
+
+# Stages of a button press, in the order they happen. Each is timed from
+# the interrupt for the first edge of the press.
+STAGES = ("debounce", "classify", "launch", "publish", "state")
+
+# A press whose state has not come back after this long is abandoned, as
+# the device is offline or never reports on that topic.
+TRACE_TIMEOUT_MS = 10000
+
+# Each power of two is split into 2**SUB_BITS buckets, so a reported
+# percentile is within 25% of the true value. Values of 2**MAX_BITS
+# microseconds (16 s) or more all go in the last bucket.
+SUB_BITS = 2
+SUB_BUCKETS = 1 << SUB_BITS
+MAX_BITS = 24
+NUM_BUCKETS = (MAX_BITS - SUB_BITS + 1) * SUB_BUCKETS
+
+
+def _bucket(value: int) -> int:
+    if value < SUB_BUCKETS:
+        return value if value > 0 else 0
+    if value >> MAX_BITS:
+        return NUM_BUCKETS - 1
+    top = SUB_BITS
+    while value >> (top + 1):
+        top += 1
+    return (top - SUB_BITS + 1) * SUB_BUCKETS + (value >> (top - SUB_BITS)) - SUB_BUCKETS
+
+
+def _upper_bound(bucket: int) -> int:
+    if bucket < SUB_BUCKETS:
+        return bucket
+    shift = bucket // SUB_BUCKETS - 1
+    return ((SUB_BUCKETS + bucket % SUB_BUCKETS + 1) << shift) - 1
+
+
+# Counts of latencies in log-linear buckets, each power of two of
+# microseconds split into SUB_BUCKETS. Percentiles are reported as the
+# bucket's upper bound.
+class Histogram:
+    def __init__(self) -> None:
+        self._buckets = array.array('I', [0] * NUM_BUCKETS)
+        self.count = 0
+        self.max = 0
+
+    def record(self, value: int) -> None:
+        self._buckets[_bucket(value)] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction: float) -> int:
+        wanted = self.count * fraction
+        total = 0
+        for bucket in range(NUM_BUCKETS):
+            total += self._buckets[bucket]
+            if total >= wanted:
+                return min(_upper_bound(bucket), self.max)
+        return self.max
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "count": self.count,
+            "p50_us": self.percentile(0.5),
+            "p95_us": self.percentile(0.95),
+            "max_us": self.max,
+        }
+
+
+# Follows one press at a time, from the interrupt to the first state
+# message from a device it sent a command to. Each stage is recorded once
+# per press. A press is abandoned after TRACE_TIMEOUT_MS, so a state message
+# long after it is not recorded against it.
+class Tracer:
+    def __init__(self) -> None:
+        self._histograms: Dict[str, Histogram] = {}
+        for stage in STAGES:
+            self._histograms[stage] = Histogram()
+        self._start: Optional[int] = None
+        self._marked: List[str] = []
+        self._expected: List[bytes] = []
+        self.timeouts = 0
+
+    def _active(self) -> bool:
+        if self._start is None:
+            return False
+        elapsed = utime.ticks_diff(utime.ticks_us(), self._start)
+        if 0 <= elapsed < TRACE_TIMEOUT_MS * 1000:
+            return True
+        self._start = None
+        self._expected = []
+        self.timeouts += 1
+        return False
+
+    def begin(self, ticks: int) -> None:
+        self._start = ticks
+        self._marked = []
+        self._expected = []
+
+    def mark(self, stage: str) -> None:
+        if stage in self._marked or not self._active():
+            return
+        self._marked.append(stage)
+        self._histograms[stage].record(utime.ticks_diff(utime.ticks_us(), self._start))
+
+    def expect(self, topic_prefix: bytes) -> None:
+        # A state message starting with topic_prefix completes the trace.
+        if self._active():
+            self._expected.append(topic_prefix)
+
+    def state(self, topic_bytes: bytes) -> None:
+        if not self._expected or not self._active():
+            return
+        for prefix in self._expected:
+            if topic_bytes.startswith(prefix):
+                self.mark("state")
+                self._start = None
+                self._expected = []
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        for stage in STAGES:
+            result[stage] = self._histograms[stage].stats()
+        result["timeouts"] = self.timeouts
+        return result
+
+
+tracer = Tracer()
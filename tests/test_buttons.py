@@ -0,0 +1,113 @@
+# Predicted button states, followed through the firmware in the host
+# harness: the LEDs a press shows before and after the device reports.
+#
+#     python3 -m pytest tests
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from host import Broker, Device, Harness  # noqa: E402
+
+from typing import Any, List, Tuple  # noqa: E402
+
+ON = [(0, 1, 0)] * 4
+OFF = [(0, 0, 1)] * 4
+PENDING_ON = [(0, 1, 0), (0, 0, 0), (0, 1, 0), (0, 0, 0)]
+
+# Long enough for a click on a light, which has to wait out the double
+# click window, to be sent and answered.
+CLICK_MS = 800
+
+
+def leds(harness: Harness, number: int) -> List[Tuple[int, ...]]:
+    # The four LEDs of a button, as main() lays them out.
+    pixels = harness.strip.pixels()
+    return [pixels[(number * 4 + 2 + i) % len(pixels)] for i in range(4)]
+
+
+def shown(harness: Harness, number: int) -> List[List[Tuple[int, ...]]]:
+    # Every pattern the button's LEDs have shown, in order, without repeats.
+    patterns: List[List[Tuple[int, ...]]] = []
+    for frame in range(len(harness.strip.frames)):
+        pixels = harness.strip.pixels(frame)
+        pattern = [pixels[(number * 4 + 2 + i) % len(pixels)] for i in range(4)]
+        if not patterns or patterns[-1] != pattern:
+            patterns.append(pattern)
+    return patterns
+
+
+class PredictionTest(unittest.TestCase):
+    def test_confirmed(self) -> None:
+        async def scenario(harness: Harness) -> Any:
+            harness.add_devices()
+            await harness.ready()
+            await harness.press("UL")
+            await harness.settle(CLICK_MS)
+            return shown(harness, 0)
+
+        patterns = Harness(Broker(latency_ms=20), quiet=True).run(scenario)
+        self.assertEqual(patterns[-3:], [OFF, PENDING_ON, ON])
+
+    def test_repeated_state_does_not_roll_back(self) -> None:
+        # The device repeats its retained power ON before the new scenes.
+        async def scenario(harness: Harness) -> Any:
+            Device(harness.broker, "Brian", "Light", scenes=["other"], power="ON")
+            await harness.ready()
+            await harness.press("UL")
+            await harness.settle(CLICK_MS)
+            return shown(harness, 0)
+
+        harness = Harness(Broker(latency_ms=2), quiet=True)
+        patterns = harness.run(scenario)
+        self.assertEqual(patterns[-3:], [OFF, PENDING_ON, ON])
+        self.assertNotIn("rolled back", harness.output)
+
+    def test_rolled_back(self) -> None:
+        # A device that ignores the command, and reports its old state on
+        # every topic.
+        state = [
+            ("state/Brian/Light/power", "OFF"),
+            ("state/Brian/Light/scenes", "[]"),
+            ("state/Brian/Light/priorities", "[]"),
+        ]
+
+        def ignore(topic: bytes, payload: bytes, retained: bool) -> None:
+            for state_topic, state_payload in state:
+                harness.inject(state_topic, state_payload, retain=True)
+
+        async def scenario(harness: Harness) -> Any:
+            for state_topic, state_payload in state:
+                harness.inject(state_topic, state_payload, retain=True)
+            await harness.ready()
+            harness.broker.listen("command/Brian/Light", ignore)
+            await harness.press("UL")
+            await harness.settle(CLICK_MS)
+            return shown(harness, 0)
+
+        harness = Harness(Broker(latency_ms=2), quiet=True)
+        patterns = harness.run(scenario)
+        self.assertEqual(patterns[-3:], [OFF, PENDING_ON, OFF])
+        self.assertIn("Brian: prediction state_on rolled back to state_off", harness.output)
+
+    def test_cancelled_prediction_is_redrawn(self) -> None:
+        # Two quick presses on a fan that never replies: the second cancels
+        # the first prediction, and the LEDs must go back to off.
+        async def scenario(harness: Harness) -> Any:
+            harness.inject("state/Brian/Fan/power", "OFF", retain=True)
+            await harness.ready()
+            await harness.press("UR")
+            await harness.settle(300)
+            pending = leds(harness, 3)
+            await harness.press("UR")
+            await harness.settle(300)
+            return pending, leds(harness, 3)
+
+        pending, settled = Harness(quiet=True).run(scenario)
+        self.assertEqual(pending, PENDING_ON)
+        self.assertEqual(settled, OFF)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+# Round trips and malformed input for the payload formats in src/formats.py.
+#
+#     python3 -m pytest tests
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import formats  # noqa: E402
+
+from typing import Any, List  # noqa: E402
+
+VALUES: List[Any] = [
+    None, True, False,
+    0, 1, 23, 24, 255, 256, 65535, 65536, 2 ** 32 - 1, 2 ** 32, 2 ** 63 - 1,
+    -1, -24, -25, -256, -257, -65537, -2 ** 31, -2 ** 63,
+    0.0, 1.5, -2.25, 1e300, -1e-300,
+    "", "a", "IETF", "üñíçødé", "x" * 300, "y" * 70000,
+    b"", b"\x00\xff", b"z" * 300,
+    [], [1, [2, 3]], list(range(30)),
+    {}, {"a": 1, "b": [2, 3]}, {"scenes": ["auto", "night"], "priorities": [100, 50]},
+    {str(i): i for i in range(20)},
+]
+
+
+class RoundTripTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        for format in ("cbor", "msgpack"):
+            for value in VALUES:
+                with self.subTest(format=format, value=repr(value)[:40]):
+                    self.assertEqual(formats.decode(formats.encode(value, format), format), value)
+
+    def test_json_and_raw(self) -> None:
+        self.assertEqual(formats.decode(formats.encode({"a": [1]}, "json"), "json"), {"a": [1]})
+        self.assertEqual(formats.decode(formats.encode("ON", "raw"), "raw"), "ON")
+
+    def test_unknown_format(self) -> None:
+        with self.assertRaises(RuntimeError):
+            formats.decode(b"", "yaml")
+        with self.assertRaises(RuntimeError):
+            formats.encode(1, "yaml")
+
+
+class CBORTest(unittest.TestCase):
+    # Examples from RFC 8949 appendix A.
+    def test_encode(self) -> None:
+        for value, expected in [
+                (0, "00"), (23, "17"), (24, "1818"), (100, "1864"), (1000, "1903e8"),
+                (-1, "20"), (-100, "3863"), ("IETF", "6449455446"), (b"\x01\x02", "420102"),
+                ([1, [2, 3]], "8201820203"), ({"a": 1, "b": [2, 3]}, "a26161016162820203"),
+                (False, "f4"), (True, "f5"), (None, "f6")]:
+            with self.subTest(value=value):
+                self.assertEqual(formats.cbor_dumps(value).hex(), expected)
+
+    def test_decode(self) -> None:
+        for payload, expected in [
+                ("f93c00", 1.0), ("f9c400", -4.0), ("f97bff", 65504.0), ("fa47c35000", 100000.0),
+                ("9fff", []), ("9f01820203ff", [1, [2, 3]]), ("bfff", {}),
+                ("bf61610161629f0203ffff", {"a": 1, "b": [2, 3]}), ("c11a514b67b0", 1363896240)]:
+            with self.subTest(payload=payload):
+                self.assertEqual(formats.cbor_loads(bytes.fromhex(payload)), expected)
+
+    def test_malformed(self) -> None:
+        for payload in [
+                "", "18", "1901", "62", "6261", "82", "8201", "a1", "a101",
+                # A break anywhere but in place of an item of an indefinite
+                # length array or map.
+                "ff", "82ff01", "a1ff01", "a101ff", "bf01ffff", "c1ff", "9fbf01ffff",
+                # Unhashable keys.
+                "a18001", "a1a00101",
+                # Unsupported or reserved.
+                "1c", "5f", "7f", "e0", "f8",
+                # Trailing data.
+                "0000", "9fff00",
+                # Unterminated indefinite length.
+                "9f01", "bf"]:
+            with self.subTest(payload=payload):
+                with self.assertRaises(ValueError):
+                    formats.cbor_loads(bytes.fromhex(payload))
+
+    def test_bad_utf8(self) -> None:
+        with self.assertRaises(ValueError):
+            formats.cbor_loads(bytes.fromhex("61ff"))
+
+
+class MessagePackTest(unittest.TestCase):
+    def test_encode(self) -> None:
+        for value, expected in [
+                (0, "00"), (127, "7f"), (128, "cc80"), (-1, "ff"), (-32, "e0"), (-33, "d0df"),
+                ("a", "a161"), ([1, 2], "920102"), ({"a": 1}, "81a16101"),
+                (None, "c0"), (False, "c2"), (True, "c3")]:
+            with self.subTest(value=value):
+                self.assertEqual(formats.msgpack_dumps(value).hex(), expected)
+
+    def test_malformed(self) -> None:
+        for payload in [
+                "", "cc", "cd01", "a2", "a261", "92", "9201", "81", "8101",
+                # Unhashable keys.
+                "819001", "818001",
+                # Unsupported.
+                "c1", "c7", "d4",
+                # Trailing data.
+                "0000"]:
+            with self.subTest(payload=payload):
+                with self.assertRaises(ValueError):
+                    formats.msgpack_loads(bytes.fromhex(payload))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+# The bulk pixel operations of src/lights.py, drawn on a ring of their own
+# while the firmware runs in the host harness.
+#
+#     python3 -m pytest tests
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from host import Harness  # noqa: E402
+
+from typing import Any, Callable, List, Tuple  # noqa: E402
+
+N = 16
+RED = (1, 0, 0)
+GREEN = (0, 1, 0)
+BLUE = (0, 0, 1)
+BLACK = (0, 0, 0)
+
+Draw = Callable[[Any, Any], None]
+
+
+def draw(*steps: Draw) -> List[Tuple[int, ...]]:
+    # Run each step with a fresh Lights and a layer on it, and return what
+    # its strip shows afterwards.
+    async def scenario(harness: Harness) -> List[Tuple[int, ...]]:
+        lights = harness.module("lights")
+        ring = lights.Lights(harness.module("machine").Pin(14))
+        task = ring.create_task(lights.LightsTask)
+        for step in steps:
+            step(ring, task)
+        task.write()
+        await harness.settle(100)
+        strip = harness.module("neopixel").NeoPixel.strips[-1]
+        pixels: List[Tuple[int, ...]] = strip.pixels()
+        return pixels
+
+    return Harness(quiet=True).run(scenario)
+
+
+def ring(*runs: Tuple[Tuple[int, int, int], int]) -> List[Tuple[int, ...]]:
+    # The pixels of the ring from index 0, as (color, count) runs.
+    pixels: List[Tuple[int, ...]] = []
+    for color, count in runs:
+        pixels.extend([color] * count)
+    return pixels
+
+
+class BlitTest(unittest.TestCase):
+    def test_blit(self) -> None:
+        pixels = draw(lambda lights, task: task.blit(lights.pack([RED, GREEN]), 3))
+        self.assertEqual(pixels, ring((BLACK, 3), (RED, 1), (GREEN, 1), (BLACK, 11)))
+
+    def test_wrap(self) -> None:
+        pixels = draw(lambda lights, task: task.blit(lights.pack([RED, GREEN]), 15))
+        self.assertEqual(pixels, ring((GREEN, 1), (BLACK, 14), (RED, 1)))
+
+    def test_start_beyond_ring(self) -> None:
+        pixels = draw(lambda lights, task: task.blit(lights.pack([RED]), N + 2))
+        self.assertEqual(pixels, ring((BLACK, 2), (RED, 1), (BLACK, 13)))
+
+    def test_longer_than_ring(self) -> None:
+        frame = [RED] * N + [BLUE] * 4
+        pixels = draw(lambda lights, task: task.blit(lights.pack(frame), 5))
+        self.assertEqual(pixels, ring((RED, N)))
+
+    def test_transparent(self) -> None:
+        def steps(lights: Any, task: Any) -> None:
+            task.fill(BLUE)
+            top = lights.create_task(type(task))
+            top.blit(lights.pack([RED, GREEN]), 15, alpha=0)
+            top.blit(lights.pack([GREEN]), 0)
+
+        pixels = draw(steps)
+        self.assertEqual(pixels, ring((GREEN, 1), (BLUE, 15)))
+
+
+class RangeTest(unittest.TestCase):
+    def test_fill_range_wrap(self) -> None:
+        pixels = draw(lambda lights, task: task.fill_range(RED, 14, 4))
+        self.assertEqual(pixels, ring((RED, 2), (BLACK, 12), (RED, 2)))
+
+    def test_fill_range_whole_ring(self) -> None:
+        pixels = draw(lambda lights, task: task.fill_range(RED, 7, N + 3))
+        self.assertEqual(pixels, ring((RED, N)))
+
+    def test_clear_range(self) -> None:
+        def steps(lights: Any, task: Any) -> None:
+            task.fill(RED)
+            task.clear_range(15, 2)
+
+        pixels = draw(steps)
+        self.assertEqual(pixels, ring((BLACK, 1), (RED, 14), (BLACK, 1)))
+
+    def test_shift(self) -> None:
+        def steps(lights: Any, task: Any) -> None:
+            task.blit(lights.pack([RED, GREEN, BLUE]), 0)
+            task.shift(14)
+
+        pixels = draw(steps)
+        self.assertEqual(pixels, ring((BLUE, 1), (BLACK, 13), (RED, 1), (GREEN, 1)))
+
+    def test_shift_back(self) -> None:
+        def steps(lights: Any, task: Any) -> None:
+            task.blit(lights.pack([RED, GREEN]), 0)
+            task.shift(-1)
+
+        pixels = draw(steps)
+        self.assertEqual(pixels, ring((GREEN, 1), (BLACK, 14), (RED, 1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+# The outbound queue of src/queues.py, with the firmware running in the host
+# harness: what is published while the broker is unreachable or failing.
+#
+#     python3 -m pytest tests
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from host import Broker, Harness  # noqa: E402
+
+from typing import Any, List  # noqa: E402
+
+# Long enough for a click on a light, which has to wait out the double
+# click window, to be queued.
+CLICK_MS = 600
+
+
+# Fails the first failures publishes of a command.
+class FailingBroker(Broker):
+    def __init__(self, failures: int) -> None:
+        super().__init__()
+        self.failures = failures
+
+    def publish(self, topic: bytes, payload: bytes, retain: bool = False) -> None:
+        if topic.startswith(b"command/") and self.failures > 0:
+            self.failures -= 1
+            raise OSError("connection reset")
+        super().publish(topic, payload, retain)
+
+
+def commands(harness: Harness, topic_filter: str) -> List[bytes]:
+    return [payload for _, _, payload, _ in harness.broker.messages(topic_filter)]
+
+
+class OutboundTest(unittest.TestCase):
+    def test_scenes_are_kept_apart(self) -> None:
+        # Dim and then default, while the broker is unreachable: both must
+        # be sent once it is back.
+        async def scenario(harness: Harness) -> Any:
+            harness.add_devices()
+            await harness.ready()
+            harness.client._connected = False
+            await harness.long_press("UL")
+            await harness.settle(CLICK_MS)
+            await harness.press("UL")
+            await harness.settle(CLICK_MS)
+            harness.client._connected = True
+            await harness.settle(CLICK_MS)
+            return commands(harness, "command/Brian/Light"), harness.mqtt.outbound.stats()
+
+        published, stats = Harness(quiet=True).run(scenario)
+        self.assertEqual(published, [
+            b'{"scene": "dim", "priority": 100}',
+            b'{"scene": "default", "priority": 100}',
+        ])
+        self.assertEqual(stats["coalesced"], 0)
+
+    def test_replaced_command_is_coalesced(self) -> None:
+        # On and then off for the fan, while the broker is unreachable: only
+        # the last one counts.
+        async def scenario(harness: Harness) -> Any:
+            harness.add_devices()
+            await harness.ready()
+            harness.client._connected = False
+            await harness.press("UR")
+            await harness.settle(100)
+            await harness.press("UR")
+            await harness.settle(100)
+            harness.client._connected = True
+            await harness.settle(CLICK_MS)
+            return commands(harness, "command/Brian/Fan"), harness.mqtt.outbound.stats()
+
+        published, stats = Harness(quiet=True).run(scenario)
+        self.assertEqual(published, [b'{"action": "turn_off"}'])
+        self.assertEqual(stats["coalesced"], 1)
+
+    def test_failed_publish_is_retried(self) -> None:
+        async def scenario(harness: Harness) -> Any:
+            harness.add_devices()
+            await harness.ready()
+            await harness.press("UR")
+            await harness.settle(CLICK_MS * 2)
+            return commands(harness, "command/Brian/Fan"), harness.mqtt.outbound.stats()
+
+        published, stats = Harness(FailingBroker(1), quiet=True).run(scenario)
+        self.assertEqual(published, [b'{"action": "turn_on"}'])
+        self.assertEqual(stats["failed"], 0)
+
+    def test_failing_publish_is_dropped(self) -> None:
+        async def scenario(harness: Harness) -> Any:
+            harness.add_devices()
+            await harness.ready()
+            outbound = harness.mqtt.outbound
+            outbound.retry_ms = 10
+            outbound.put(b"command/Brian/Fan", b'{"action": "turn_on"}')
+            sent = await outbound.sent([b"command/Brian/Fan"])
+            return sent, commands(harness, "command/Brian/Fan"), outbound.stats()
+
+        sent, published, stats = Harness(FailingBroker(10), quiet=True).run(scenario)
+        self.assertIsNone(sent)
+        self.assertEqual(published, [])
+        self.assertEqual(stats["failed"], 1)
+
+    def test_sent_times_out(self) -> None:
+        async def scenario(harness: Harness) -> Any:
+            await harness.ready()
+            outbound = harness.mqtt.outbound
+            harness.client._connected = False
+            outbound.put(b"command/Brian/Fan", b'{"action": "turn_on"}')
+            sent = await outbound.sent([b"command/Brian/Fan"], 100)
+            return sent, len(outbound)
+
+        sent, depth = Harness(quiet=True).run(scenario)
+        self.assertIsNone(sent)
+        # Still queued, to be sent once the broker is back.
+        self.assertEqual(depth, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+# Replaying retained messages to late subscribers, with the firmware running
+# in the host harness.
+#
+#     python3 -m pytest tests
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from host import Harness  # noqa: E402
+
+from typing import Any, List, Tuple  # noqa: E402
+
+SCENES = ["state", "Brian", "Light", "scenes"]
+
+
+def replay(*subscribers: Tuple[List[str], str]) -> Any:
+    # Subscribe to each (filter, format) once the firmware is ready, and
+    # return what they were sent, the formats decoded on the way and the
+    # retained cache's stats before and after.
+    async def scenario(harness: Harness) -> Any:
+        harness.add_devices()
+        await harness.ready()
+        subscriptions = harness.mqtt.subscriptions
+        formats = harness.module("formats")
+        decode = formats.decode
+        decoded: List[str] = []
+
+        def counting(payload: bytes, format: str) -> Any:
+            decoded.append(format)
+            return decode(payload, format)
+
+        formats.decode = counting
+        received: List[Tuple[bytes, Any]] = []
+
+        async def callback(topic: bytes, label: Any, data: Any) -> None:
+            received.append((topic, data))
+
+        before = subscriptions.retained.stats()
+        for topic_filter, format in subscribers:
+            await subscriptions.subscribe(topic_filter, None, callback, format)
+        return received, decoded, before, subscriptions.retained.stats()
+
+    return Harness(quiet=True).run(scenario)
+
+
+class RetainedReplayTest(unittest.TestCase):
+    def test_decoded_values_are_shared(self) -> None:
+        # The buttons have already had the scenes as JSON.
+        received, decoded, _, _ = replay((SCENES, "json"), (SCENES, "json"))
+        self.assertEqual(received, [(b"state/Brian/Light/scenes", [])] * 2)
+        self.assertEqual(decoded, [])
+
+    def test_new_format_is_decoded_once(self) -> None:
+        received, decoded, before, after = replay((SCENES, "raw"), (SCENES, "raw"))
+        self.assertEqual(received, [(b"state/Brian/Light/scenes", "[]")] * 2)
+        self.assertEqual(decoded, ["raw"])
+        # The decoded value counts against the cache's budget.
+        self.assertGreater(after["bytes"], before["bytes"])
+
+    def test_wildcard(self) -> None:
+        received, decoded, _, _ = replay((["state", "+", "Light", "power"], "raw"))
+        self.assertEqual(sorted(received), [
+            (b"state/Brian/Light/power", "OFF"),
+            (b"state/Passage/Light/power", "OFF"),
+            (b"state/Twins/Light/power", "OFF"),
+        ])
+        self.assertEqual(decoded, [])
+
+
+if __name__ == "__main__":
+    unittest.main()